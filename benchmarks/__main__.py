@@ -0,0 +1,167 @@
+import os, sys  # two lines to use the local package
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+
+# the overhead benchmark suite of peek itself
+#
+# usage: python -m benchmarks [--save results.json] [--compare baseline.json] [--threshold 0.1] [--quick] [name ...]
+#
+# Each benchmark is a call of peek (in a certain configuration), that is repeated until it takes a measurable time.
+# The reported time per call is the minimum of several repeats, as that's the least disturbed by other processes.
+# With --save, the results are written as JSON. With --compare, the results are compared with a saved baseline and
+# every benchmark that's more than threshold (default 10%) slower is flagged as a regression (and the exit code is 1).
+
+import argparse
+import json
+import logging
+import platform
+import tempfile
+import time
+from pathlib import Path
+
+from peek import peek, __version__
+
+peek = peek.new(ignore_toml=True)
+
+
+def benchmarks(tmpdir):
+    # returns a dict with the name and a function without arguments of every benchmark
+    x = 12
+    nested = {f"key{i}": {f"sub{j}": list(range(10)) for j in range(10)} for i in range(10)}
+
+    logger = logging.getLogger("peek_benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    devnull = open(os.devnull, "w")
+
+    def callable_output(s):
+        pass
+
+    null = peek.new(output="null")
+    disabled = peek.new(enabled=False)
+    to_devnull = peek.new(output=devnull)
+    to_debug = peek.new(output="logging.debug:peek_benchmark")
+
+    @null.timer
+    def timed(x):
+        return x
+
+    @null.timer(aggregate=True)
+    def aggregated(x):
+        return x
+
+    @null.timer(threshold=1)
+    def timed_threshold(x):
+        return x
+
+    @disabled.timer
+    def timed_disabled(x):
+        return x
+
+    def with_timer():
+        with null.timer():
+            pass
+
+    def stdout():
+        saved = sys.stdout
+        sys.stdout = devnull
+        try:
+            peek(x)
+        finally:
+            sys.stdout = saved
+
+    return {
+        "disabled": lambda: disabled(x),
+        "disabled with kwargs": lambda: disabled(x, color="red", ll=120),
+        "int": lambda: null(x),
+        "large nested dict": lambda: null(nested),
+        "values_only": lambda: null(x, values_only=True),
+        "show_time": lambda: null(x, show_time=True),
+        "show_delta": lambda: null(x, show_delta=True),
+        "filter, suppressed": lambda: null(x, filter="level >= 1"),
+        "filter, passed": lambda: null(x, level=1, filter="level >= 1"),
+        "as_str": lambda: null(x, as_str=True),
+        "json_lines": lambda: null(x, json_lines=True),
+        "deferred": lambda: null(x, deferred=True),
+        "output stdout": stdout,
+        "output open file": lambda: to_devnull(x),
+        "output path": lambda: null(x, output=Path(tmpdir) / "peek.txt"),
+        "output callable": lambda: null(x, output=callable_output),
+        "output logging": lambda: null(x, output="logging.info:peek_benchmark"),
+        "output logging, disabled level": lambda: null(x, output="logging.debug:peek_benchmark"),
+        "output logging, disabled level, configured": lambda: to_debug(x),
+        "output async": lambda: null(x, async_output=True),
+        "timer decorator": lambda: timed(x),
+        "timer decorator, aggregate": lambda: aggregated(x),
+        "timer decorator, threshold": lambda: timed_threshold(x),
+        "timer decorator, disabled": lambda: timed_disabled(x),
+        "timer context manager": with_timer,
+    }
+
+
+def time_per_call(function, repeat, min_time):
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            function()
+        if time.perf_counter() - t0 >= min_time:
+            break
+        number *= 2
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            function()
+        duration = (time.perf_counter() - t0) / number
+        if best is None or duration < best:
+            best = duration
+    peek.flush()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="overhead benchmarks of peek")
+    parser.add_argument("names", nargs="*", help="only run the benchmarks that contain any of these names")
+    parser.add_argument("--save", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="compare the results with this (saved) baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown that is flagged as a regression (default 0.1)")
+    parser.add_argument("--quick", action="store_true", help="fewer and shorter repeats")
+    arguments = parser.parse_args()
+
+    repeat, min_time = (3, 0.02) if arguments.quick else (7, 0.1)
+    baseline = json.loads(Path(arguments.compare).read_text())["results"] if arguments.compare else {}
+
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, function in benchmarks(tmpdir).items():
+            if arguments.names and not any(part in name for part in arguments.names):
+                continue
+            results[name] = time_per_call(function, repeat, min_time)
+            line = f"{name:35} {results[name] * 1e6:10.3f} us"
+            if name in baseline:
+                change = results[name] / baseline[name] - 1
+                line += f" {baseline[name] * 1e6:10.3f} us {change:+8.1%}"
+                if change > arguments.threshold:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line)
+        peek.reset()
+
+    if arguments.save:
+        Path(arguments.save).write_text(
+            json.dumps(
+                dict(peek_version=__version__, python=platform.python_version(), platform=platform.platform(), results=results),
+                indent=4,
+            )
+        )
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
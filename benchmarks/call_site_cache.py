@@ -0,0 +1,35 @@
+import os, sys  # two lines to use the local package
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+
+import time
+
+from peek import peek
+
+peek = peek.new(ignore_toml=True, output="null")
+_Peek = type(peek)
+
+N = 20_000
+
+
+def per_call(cold):
+    x = 1
+    t0 = time.perf_counter()
+    for _ in range(N):
+        if cold:
+            _Peek._call_sites.clear()  # mimics the behaviour before caching call site information
+        peek(x)
+    return (time.perf_counter() - t0) / N
+
+
+def main():
+    per_call(cold=False)  # warm up
+    cold = per_call(cold=True)
+    warm = per_call(cold=False)
+    print(f"peek(x) from the same line, without call site cache: {cold * 1e6:9.2f} us per call")
+    print(f"peek(x) from the same line, with call site cache   : {warm * 1e6:9.2f} us per call")
+    print(f"speedup                                            : {cold / warm:9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import os, sys  # two lines to use the local package
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+
+import tempfile
+import time
+from pathlib import Path
+
+from peek import peek
+
+peek = peek.new(ignore_toml=True)
+
+N = 5_000
+
+
+def per_call(**kwargs):
+    # returns the time per call on the calling thread and the time per call including the rendering
+    d = dict(a=list(range(40)), b="peek" * 10)
+    peek0 = peek.fork(**kwargs)
+    t0 = time.perf_counter()
+    for _ in range(N):
+        peek0(d)
+    t1 = time.perf_counter()
+    peek0.flush()
+    t2 = time.perf_counter()
+    return (t1 - t0) / N, (t2 - t0) / N
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "peek.txt"
+        for label, kwargs in (
+            ("immediate rendering", dict(output=path)),
+            ("deferred=True", dict(output=path, deferred=True)),
+            ("deferred=True, async_output=True", dict(output=path, deferred=True, async_output=True)),
+            ("deferred=<record file>", dict(deferred=Path(tmpdir) / "peek.records")),
+        ):
+            calling, total = per_call(**kwargs)
+            print(f"{label:35} {calling * 1e6:8.2f} us per call on the calling thread ({total * 1e6:8.2f} us including rendering)")
+        peek.reset()
+
+
+if __name__ == "__main__":
+    main()
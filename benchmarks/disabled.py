@@ -0,0 +1,44 @@
+import os, sys  # two lines to use the local package
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+
+import time
+
+from peek import peek
+
+peek = peek.new(ignore_toml=True, enabled=False)
+
+N = 1_000_000
+
+
+def bare(x):
+    return x
+
+
+def per_call(function):
+    x = 1
+    t0 = time.perf_counter()
+    for _ in range(N):
+        function(x)
+    return (time.perf_counter() - t0) / N
+
+
+def main():
+    def with_kwargs(x):
+        return peek(x, color="red", ll=120)
+
+    @peek.timer
+    def timed(x):
+        return x
+
+    for label, function in (
+        ("bare function call", bare),
+        ("disabled peek(x)", peek),
+        ("disabled peek(x, color='red', ll=120)", with_kwargs),
+        ("function decorated with disabled peek.timer", timed),
+    ):
+        print(f"{label:45} {per_call(function) * 1e9:8.1f} ns per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import os, sys  # two lines to use the local package
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+
+import tempfile
+import time
+from pathlib import Path
+
+from peek import peek
+
+peek = peek.new(ignore_toml=True)
+
+N = 20_000
+
+
+def open_per_record(path):
+    # the file output as it was before the persistent file sink
+    def output(s):
+        with open(path, "a+", encoding="utf-8") as f:
+            print(s, file=f, end="")
+
+    return output
+
+
+def records_per_second(output_only, **kwargs):
+    x = 1
+    peek0 = peek.fork(**kwargs)
+    t0 = time.perf_counter()
+    if output_only:
+        for _ in range(N):
+            peek0.do_output("x=1")
+    else:
+        for _ in range(N):
+            peek0(x)
+    peek0.flush()
+    return N / (time.perf_counter() - t0)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "peek.txt"
+        for label, kwargs in (
+            ("open and close per record", dict(output=open_per_record(path))),
+            ("file sink, flush after every record", dict(output=path, flush_interval=0)),
+            ("file sink, flush every second", dict(output=path, flush_interval=1)),
+        ):
+            print(
+                f"{label:40} {records_per_second(True, **kwargs):10,.0f} records per second"
+                f" (including peek call: {records_per_second(False, **kwargs):8,.0f})"
+            )
+        peek.reset()
+
+
+if __name__ == "__main__":
+    main()
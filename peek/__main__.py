@@ -0,0 +1,16 @@
+import sys
+
+from .peek import _Deferred
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python -m peek <record file> [<record file> ...]")
+        print("renders the records written by peek with deferred=<record file>")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        _Deferred.decode(path)
+
+
+if __name__ == "__main__":
+    main()
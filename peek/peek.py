@@ -32,6 +32,21 @@ import types
 import pprint
 import builtins
 import shutil
+import weakref
+import threading
+import atexit
+import collections
+import json
+import random
+import zlib
+import copy
+import math
+import reprlib
+import gc
+import contextvars
+import statistics
+import tracemalloc
+import itertools
 
 __version__ = "26.1.2"
 
@@ -48,6 +63,11 @@ else:
 
     colorama.just_fix_windows_console()
 
+try:
+    import resource  # not available on Windows
+except ModuleNotFoundError:
+    resource = None
+
 try:
     import tomllib
 except ModuleNotFoundError:
@@ -59,38 +79,63 @@ lf = "\n"
 class _Peek:
     name_alias_default = (
         # name, alias, default value
+        ("aggregate", "agg", False),
         ("as_timer", "at", False),
+        ("async_output", "ao", False),
+        ("buffer_size", "", 65536),
+        ("capture", "", repr),
         ("color", "col", "-"),
         ("color_value", "col_val", ""),
         ("compact", "", False),
         ("context_separator", "cs", " ==> "),
+        ("dedupe", "", False),
+        ("deferred", "", False),
         ("delta", "", 0),
         ("depth", "", 1000000),
         ("enabled", "", True),
         ("end", "", lf),
         ("equals_separator", "", "="),
+        ("every", "", 1),
         ("filter", "f", ""),
+        ("flush_interval", "", 0),
         ("format", "fmt", ""),
         ("indent", "", 1),
+        ("json_lines", "jl", False),
         ("level", "lvl", 0),
         ("line_length", "ll", 80),
+        ("max_arg_chars", "", 0),
+        ("max_arg_items", "", 0),
         ("max_lines", "ml", 1000000),
+        ("max_per_second", "mps", 0),
+        ("min_time", "", 0.1),
         ("output", "", "stdout"),
+        ("overflow", "", "block"),
         ("prefix", "pr", ""),
         ("print_like", "print", False),
+        ("queue_size", "", 10000),
         ("quote_string", "qs", True),
+        ("repeat", "", 7),
+        ("report_interval", "", 0),
         ("return_none", "", False),
+        ("sample", "", 1),
+        ("sample_key", "", ""),
         ("separator", "sep", ", "),
         ("separator_print", "sepp", " "),
         ("serialize", "", pprint.pformat),
+        ("show_args", "", "repr"),
+        ("show_cpu", "", False),
         ("show_delta", "sd", False),
         ("show_enter", "se", True),
         ("show_exit", "sx", True),
+        ("show_gc", "", False),
         ("show_line_number", "sln", False),
+        ("show_memory", "", False),
         ("show_time", "st", False),
         ("show_traceback", "", False),
         ("sort_dicts", "", False),
+        ("threshold", "", 0),
         ("to_clipboard", "clip", False),
+        ("tree", "", False),
         ("underscore_numbers", "un", False),
         ("use_color", "", False if Pyodide else True),
         ("values_only", "vo", False),
@@ -104,6 +149,15 @@ class _Peek:
     name_and_alias_default = name_default | alias_default
 
     _fixed_perf_counter = None
+    _call_sites = {}
+    _call_sites_max = 10_000  # the cache holds the code objects, so it's bounded for code that's generated on the fly
+    _compiled_filters = {}
+    _generation = 0
+    _validated_specs = {}
+    _accepted_parameters = weakref.WeakKeyDictionary()
+    _limited_reprs = {}
+    _logging_levels = dict(debug=logging.DEBUG, info=logging.INFO, warning=logging.WARNING, error=logging.ERROR, critical=logging.CRITICAL)
+    _logging_targets = {}  # output string -> (logger, level) or None
 
     _color_name_to_ANSI = dict(
         dark_black="\033[0;30m",
@@ -170,6 +224,7 @@ class _Peek:
             return
         if name == "output":
             if callable(value):
+                _Peek.accepted_parameters(value)
                 return
             if isinstance(value, (str, Path)):
                 return
@@ -181,9 +236,18 @@ class _Peek:
             raise AttributeError("output should be a callable, str, Path or open text file.")
 
         elif name == "serialize":
+            if callable(value):
+                _Peek.accepted_parameters(value)
+                return
+
+        elif name == "capture":
             if callable(value):
                 return
 
+        elif name == "deferred":
+            if isinstance(value, (bool, str, Path)):
+                return
+
         elif name in ("color", "color_value"):
             if isinstance(value, str) and value in _Peek._color_name_to_ANSI:
                 return
@@ -206,6 +270,62 @@ class _Peek:
             if isinstance(value, numbers.Number):
                 return
 
+        elif name == "buffer_size":
+            if isinstance(value, int) and (value == -1 or value >= 1):
+                return
+
+        elif name == "queue_size":
+            if isinstance(value, int) and value > 0:
+                return
+
+        elif name == "overflow":
+            if value in ("block", "drop_oldest", "drop_newest"):
+                return
+
+        elif name == "flush_interval":
+            if isinstance(value, numbers.Number) and value >= 0:
+                return
+
+        elif name == "every":
+            if isinstance(value, int) and value >= 1:
+                return
+
+        elif name == "sample":
+            if isinstance(value, numbers.Number) and 0 <= value <= 1:
+                return
+
+        elif name in ("max_arg_chars", "max_arg_items"):
+            if isinstance(value, int) and value >= 0:
+                return
+
+        elif name == "show_args":
+            if value in ("repr", "type", "len"):
+                return
+
+        elif name == "show_memory":
+            if isinstance(value, int) and value >= 0:
+                return
+
+        elif name == "repeat":
+            if isinstance(value, int) and value >= 1:
+                return
+
+        elif name == "min_time":
+            if isinstance(value, numbers.Number) and value > 0:
+                return
+
+        elif name == "threshold":
+            if isinstance(value, numbers.Number) and value >= 0:
+                return
+
+        elif name == "report_interval":
+            if isinstance(value, numbers.Number) and value >= 0:
+                return
+
+        elif name == "max_per_second":
+            if isinstance(value, numbers.Number) and value >= 0:
+                return
+
         elif name == "max_lines":
             if isinstance(value, numbers.Number) and value > 0:
                 return
@@ -227,10 +347,10 @@ class _Peek:
                 ...
 
         elif name == "filter":
-            if value.strip() == "":
-                return
             try:
-                eval(value, _Peek.name_and_alias_default)
+                compiled_filter = _Peek.compile_filter(value)
+                if compiled_filter is not None:
+                    eval(compiled_filter[0], dict(_Peek.name_and_alias_default))
                 return
             except Exception:
                 ...
@@ -240,8 +360,69 @@ class _Peek:
 
         raise AttributeError(f"incorrect {name_org}: {repr(value)}{_Peek.in_read_toml_message}")
 
+    @staticmethod
+    def accepted_parameters(function):
+        # returns the names of the parameters of function, cached as inspect.signature is expensive
+        key = getattr(function, "__func__", function)  # bound methods are created on every attribute access
+        try:
+            return _Peek._accepted_parameters[key]
+        except (KeyError, TypeError):
+            pass
+        if function == builtins.print:  # for Python <= 3.10, builtins.print has no signature
+            parameters = frozenset(("sep", "end", "file", "flush"))
+        else:
+            try:
+                parameters = frozenset(inspect.signature(function).parameters)
+            except (TypeError, ValueError):
+                parameters = frozenset()
+        try:
+            _Peek._accepted_parameters[key] = parameters
+        except TypeError:  # not weak referenceable
+            pass
+        return parameters
+
+    @staticmethod
+    def compile_filter(filter):
+        # returns None for an empty filter, else the compiled filter and the names of the attributes it refers to
+        if filter not in _Peek._compiled_filters:
+            if filter.strip() == "":
+                compiled_filter = None
+            else:
+                code = compile(filter, "<filter>", "eval")
+                names = set()
+                codes = [code]
+                while codes:  # names used in comprehensions and lambdas are in nested code objects
+                    code_ = codes.pop()
+                    names.update(code_.co_names)
+                    codes.extend(const for const in code_.co_consts if isinstance(const, types.CodeType))
+                compiled_filter = (code, tuple(name for name in _Peek.name_and_alias_default if name in names))
+            _Peek._compiled_filters[filter] = compiled_filter
+        return _Peek._compiled_filters[filter]
+
     @staticmethod
     def spec_to_attributes(**kwargs):
+        # the validated attributes are cached, so literal overrides at a call site are validated only once.
+        # Unhashable values and open files (which might be closed later) are always validated.
+        output = kwargs.get("output")
+        if output is None or callable(output) or isinstance(output, (str, Path)):
+            key = tuple((name, type(value), value) for name, value in kwargs.items())
+            try:
+                result = _Peek._validated_specs.get(key)
+            except TypeError:
+                return _Peek.validate_spec(kwargs)
+            if result is None:
+                result = _Peek.validate_spec(kwargs)
+                if len(_Peek._validated_specs) >= 1024:
+                    _Peek._validated_specs.clear()
+                _Peek._validated_specs[key] = result
+            result = dict(result)
+            if "delta1" in result:
+                result["delta1"] = _Peek.perf_counter()
+            return result
+        return _Peek.validate_spec(kwargs)
+
+    @staticmethod
+    def validate_spec(kwargs):
         result = {}
         for name, value in kwargs.items():
             if _Peek.alias_name.get(name, "") in kwargs:
@@ -319,9 +500,94 @@ class _Peek:
     def perf_counter():
         return time.perf_counter() if _Peek._fixed_perf_counter is None else _Peek._fixed_perf_counter
 
+    @staticmethod
+    def call_site(call_frame):
+        # everything that can be derived from the source of a call site does not depend on the configuration,
+        # so it is determined only once per (code object, bytecode offset).
+        # The key is the id of the code object, as code objects with the same content compare equal (regardless of the filename).
+        # The call site holds a reference to the code object, so the id can't be reused as long as the call site is cached.
+        key = (id(call_frame.f_code), call_frame.f_lasti)
+        if key in _Peek._call_sites:
+            return _Peek._call_sites[key]
+
+        filename = call_frame.f_code.co_filename
+        if filename in ("<stdin>", "<string>"):
+            filename_name = ""
+            line_number = 0
+            qualname = ""
+        else:
+            try:
+                main_file = sys.modules["__main__"].__file__
+                main_file_resolved = os.path.abspath(main_file)
+            except AttributeError:
+                main_file_resolved = None
+            filename_resolved = os.path.abspath(filename)
+            if (filename.startswith("<") and filename.endswith(">")) or (main_file_resolved is None) or (filename_resolved == main_file_resolved):
+                filename_name = ""
+            else:
+                filename_name = f"[{os.path.basename(filename)}]"
+
+            frame_info = inspect.getframeinfo(call_frame, context=1)
+            if frame_info.code_context is None:
+                line_number = 0
+            else:
+                line_number = frame_info.lineno
+
+            qualname = executing.Source.executing(call_frame).code_qualname().replace(".<locals>.", ".")
+
+        call_node = executing.Source.executing(call_frame).node
+        if not isinstance(call_node, ast.Call):  # no node found or peek used as a decorator
+            labels = None
+        else:
+            labels = []
+            source = executing.Source.for_frame(call_frame)
+            for node in call_node.args:
+                left = source.asttokens().get_text(node)
+                if lf in left:
+                    left = " " * node.first_token.start[1] + left
+                    left = textwrap.dedent(left)
+                is_fstring = False
+                try:
+                    ast.literal_eval(left)  # it's indeed a literal
+                    left = ""
+                except Exception:
+                    pass
+                if left:
+                    try:
+                        s = ast.parse(left, mode="eval")
+                        if isinstance(s, ast.Expression):
+                            s = s.body
+                        if s and isinstance(s, ast.JoinedStr):  # it is indeed an f-string
+                            is_fstring = True
+                    except Exception:
+                        pass
+                labels.append((left, is_fstring))
+
+        call_site = types.SimpleNamespace(
+            code=call_frame.f_code,
+            key=key,
+            filename=filename, filename_name=filename_name, line_number=line_number, qualname=qualname, found=call_node is not None, labels=labels
+        )
+        if len(_Peek._call_sites) >= _Peek._call_sites_max:
+            _Peek._call_sites.pop(next(iter(_Peek._call_sites)), None)  # the oldest entry (unless another thread removed it already)
+        _Peek._call_sites[key] = call_site
+        return call_site
+
+    @staticmethod
+    def kwarg_or_resolved(kwargs, resolved, name, alias=""):
+        for key in (name, alias):
+            if kwargs.get(key) is not None:
+                return kwargs[key]
+        return resolved[name]
+
     def __init__(self, parent=None, **kwargs):
-        self._attributes = _Peek.spec_to_attributes(**kwargs)
-        self._parent = parent
+        # a new instance can't have any descendants yet, so there's no need to invalidate any resolved attributes
+        super().__setattr__("_resolved_generation", -1)
+        super().__setattr__("_attributes", _Peek.spec_to_attributes(**kwargs))
+        super().__setattr__("_parent", parent)
+        super().__setattr__("_has_children", False)
+        if parent is not None and not parent._has_children:
+            super(_Peek, parent).__setattr__("_has_children", True)
 
     def new(self, ignore_toml=False, **kwargs):
         if ignore_toml:
@@ -334,51 +600,91 @@ class _Peek:
 
     def clone(self, **kwargs):
         clone = _Peek(parent=self._parent)
-        clone._attributes = self._attributes | _Peek.spec_to_attributes(**kwargs)
+        super(_Peek, clone).__setattr__("_attributes", self._attributes | _Peek.spec_to_attributes(**kwargs))
         return clone
 
     def configure(self, **kwargs):
-        self._attributes.update(_Peek.spec_to_attributes(**kwargs))
+        attributes = _Peek.spec_to_attributes(**kwargs)
+        if "output" in attributes:
+            _FileSink.flush_all()
+        self._attributes.update(attributes)
+        self.invalidate_resolved()
+
+    def invalidate_resolved(self):
+        # after a change of the attributes of this instance, the resolved attributes of this instance and of all its
+        # descendants are outdated. An instance without descendants (like the forks that are made for every call)
+        # only invalidates its own resolved attributes, so not those of all other instances.
+        if self._has_children:
+            _Peek._generation += 1
+        else:
+            super().__setattr__("_resolved_generation", -1)
+
+    def resolved_attributes(self):
+        # returns the effective configuration as one dict, which is only rebuilt after an attribute
+        # of any instance has been changed (that is signalled by incrementing _Peek._generation)
+        if self._resolved_generation != _Peek._generation:
+            own = {name: value for name, value in self._attributes.items() if value is not None}
+            if "delta" not in own:
+                own.pop("delta1", None)  # delta1 is only meaningful together with delta
+            if self._parent is None:
+                resolved = own
+            else:
+                resolved = self._parent.resolved_attributes()
+                if own:
+                    resolved = resolved | own
+            super().__setattr__("_resolved", resolved)
+            super().__setattr__("_resolved_generation", _Peek._generation)
+        return self._resolved
 
     def __getattr__(self, item):
         item = _Peek.de_alias(item)
         if item in _Peek.name_default or item == "delta1":
-            node = self
-            while item not in node._attributes or node._attributes[item] is None:
-                node = node._parent
+            resolved = self.resolved_attributes()
             if item == "delta":
-                return _Peek.perf_counter() - node._attributes["delta1"] + node._attributes["delta"]
+                return _Peek.perf_counter() - resolved["delta1"] + resolved["delta"]
             elif item == "delta1":
-                return node._attributes["delta"]
+                return resolved["delta"]
             elif item == "prefix":
-                prefix = node._attributes[item]
+                prefix = resolved[item]
                 return str(prefix() if callable(prefix) else prefix)
             else:
-                return node._attributes[item]
+                return resolved[item]
         else:
             return self.__getattribute__(item)
 
     def __setattr__(self, item, value):
-        if item in ("_parent", "_line_number_with_filename_and_parent", "_save_traceback", "_enter_time", "_as_str", "_attributes", "_real_decorator"):
+        if item in ("_line_number_with_filename_and_parent", "_call_site", "_save_traceback", "_enter_time", "_as_str", "_real_decorator"):
             return super().__setattr__(item, value)
-        self._attributes.update(_Peek.spec_to_attributes(**{item: value}))
+        if item in ("_parent", "_attributes"):
+            super().__setattr__(item, value)
+            if item == "_parent" and value is not None:
+                super(_Peek, value).__setattr__("_has_children", True)
+        else:
+            attributes = _Peek.spec_to_attributes(**{item: value})
+            if "output" in attributes:
+                _FileSink.flush_all()
+            self._attributes.update(attributes)
+        self.invalidate_resolved()
 
     def __repr__(self):
-        pairs = [f"{name}={getattr(self, 'delta1') if name == 'delta' else getattr(self, name)!r}" for name in _Peek.name_default if name != "serialize"]
+        pairs = [f"{name}={getattr(self, 'delta1') if name == 'delta' else getattr(self, name)!r}" for name in _Peek.name_default if name not in ("serialize", "capture")]
         return f"peek.new({', '.join(pairs)})"
 
     def __str__(self):
-        pairs = [f"{name}={getattr(self, 'delta1') if name == 'delta' else getattr(self, name)!r}" for name in _Peek.name_default if name != "serialize"]
+        pairs = [f"{name}={getattr(self, 'delta1') if name == 'delta' else getattr(self, name)!r}" for name in _Peek.name_default if name not in ("serialize", "capture")]
         return f"peek with attributes:{lf}    {'{lf}    '.join(pairs)}"
 
     def fix_perf_counter(self, val):  # for tests
         _Peek._fixed_perf_counter = val
 
     def do_show(self):
-        if not self.enabled:
+        resolved = self.resolved_attributes()
+        if not resolved["enabled"]:
             return False
-        if self.filter.strip() != "":
-            if not eval(self.filter, {name: getattr(self, name) for name in list(_Peek.name_default) + list(_Peek.alias_default)}):
+        compiled_filter = _Peek.compile_filter(resolved["filter"])
+        if compiled_filter is not None:
+            code, names = compiled_filter
+            if not eval(code, {name: getattr(self, name) for name in names}):
                 return False
         return True
 
@@ -390,32 +696,50 @@ class _Peek:
         return self(*args, as_str=as_str, **kwargs)
 
     def __call__(self, *args, as_str=False, **kwargs):
-        def add_to_pairs(pairs, left, right):
+        resolved = self._resolved if self._resolved_generation == _Peek._generation else self.resolved_attributes()
+        if "enabled" not in kwargs and not (resolved["enabled"] and (as_str or "output" in kwargs or _Peek.logging_enabled(resolved["output"]))):
+            # statically disabled (or the output goes to a logger that would discard the record anyway),
+            # so no need to fork, validate the kwargs or inspect any frames
+            if kwargs:
+                as_timer = _Peek.kwarg_or_resolved(kwargs, resolved, "as_timer", "at")
+                return_none = _Peek.kwarg_or_resolved(kwargs, resolved, "return_none")
+            else:
+                as_timer = resolved["as_timer"]
+                return_none = resolved["return_none"]
+            if as_timer:
+                return args[0] if len(args) == 1 and callable(args[0]) else _NullTimer()
+            if as_str:
+                return ""
+            if return_none or not args:
+                return None
+            return args[0] if len(args) == 1 else args
+
+        def add_to_pairs(pairs, label, right):
             if right is locals or right is globals or right is vars:
                 frame=real_caller_frame()
                 for name, value in {locals: frame.f_locals, globals: frame.f_globals, vars: frame.f_locals}[right].items():
                     if not (isinstance(value, _PeekModule) or name.startswith("__")):
-                        pairs.append(Pair(left=f"{name}{this.equals_separator}", right=value))
+                        pairs.append(Pair(label=name, left=f"{name}{this.equals_separator}", right=value, serialized=_Serialized(this, value)))
             else:
-                pairs.append(Pair(left=left, right=right))
+                pairs.append(Pair(label=label, left=f"{label}{this.equals_separator}" if label else "", right=right, serialized=_Serialized(this, right)))
 
         this = self.fork(**kwargs)
-        if not this.do_show():
-            if this.as_timer:
-                this._real_decorator = lambda x: x
-                return _Timer(this)
+        resolved = this.resolved_attributes()
+        if not this.do_show() or not (as_str or resolved["as_timer"] or this.output_wanted()):
+            if resolved["as_timer"]:
+                return args[0] if len(args) == 1 and callable(args[0]) else _NullTimer()
             else:
                 if as_str:
                     return ""
                 else:
                     return this.return_args(args)
 
-        if this.line_length in (0, "terminal_width"):
+        if resolved["line_length"] in (0, "terminal_width"):
             this.line_length = shutil.get_terminal_size().columns
 
         this._as_str = as_str
 
-        if this.print_like:
+        if resolved["print_like"]:
             seps = [name for name in ("sep", "separator") if name in kwargs]
             sepps = [name for name in ("sepp", "separator_print") if name in kwargs]
 
@@ -433,70 +757,83 @@ class _Peek:
             args = [this.separator_print.join(map(str, args))]
 
         Pair = types.SimpleNamespace
-            
-        call_frame=real_caller_frame()
-        filename = call_frame.f_code.co_filename
-        
-        if filename in ("<stdin>", "<string>"):
-            filename_name = ""
-            line_number = 0
-            parent_function = ""
-        else:
-            try:
-                main_file = sys.modules["__main__"].__file__
-                main_file_resolved = os.path.abspath(main_file)
-            except AttributeError:
-                main_file_resolved = None
-            filename_resolved = os.path.abspath(filename)
-            if (filename.startswith("<") and filename.endswith(">")) or (main_file_resolved is None) or (filename_resolved == main_file_resolved):
-                filename_name = ""
-            else:
-                filename_name = f"[{os.path.basename(filename)}]"
 
-            frame_info = inspect.getframeinfo(call_frame, context=1)
-            if frame_info.code_context is None:
-                line_number = 0
-            else:
-                line_number = frame_info.lineno
-
-            parent_function = executing.Source.executing(call_frame).code_qualname()
-            parent_function = parent_function.replace(".<locals>.", ".")
-            if parent_function == "<module>" or str(this.show_line_number) in ("n", "no parent"):
-                parent_function = ""
-            else:
-                parent_function = f" in {parent_function}()"
+        call_frame = real_caller_frame()
+        call_site = _Peek.call_site(call_frame)
+        parent_function = this.locate(call_site)
 
-        call_node = executing.Source.executing(call_frame).node
-        if call_node is None:
-            this._line_number_with_filename_and_parent = ""
-        else:
-            this._line_number_with_filename_and_parent = f"#{line_number}{filename_name}{parent_function}"
+        resolved = this.resolved_attributes()  # again, as the attributes might have been changed above
+        if (resolved["every"] != 1 or resolved["sample"] != 1 or resolved["max_per_second"]) and not (as_str or resolved["as_timer"]):
+            # decided before any serialization, so a suppressed call is cheap
+            if not _Throttle.get(call_site).allows(this, resolved):
+                return this.return_args(args)
 
-        if this.as_timer:
+        if resolved["as_timer"]:
             if as_str:
                 raise TypeError("as_str may not be True when peek used as timer")
             if len(args) > 1 or (len(args) == 1 and not callable(args[0])):
                 raise TypeError("non-keyword arguments are not allowed when peek used as timer")
 
-            this._line_number_with_filename_and_parent = f"#{line_number}{filename_name}{parent_function}"
+            this._line_number_with_filename_and_parent = f"#{call_site.line_number}{call_site.filename_name}{parent_function}"
 
             def real_decorator(function):
+                stats_key = getattr(function, "__code__", function)
+                stats_label = f"{getattr(function, '__qualname__', function.__name__).replace('.<locals>.', '.')}()"
+
+                if inspect.iscoroutinefunction(function):
+                    return this.coroutine_timer(function, stats_key, stats_label)
+                if inspect.isasyncgenfunction(function):
+                    return this.async_generator_timer(function, stats_key, stats_label)
+                if inspect.isgeneratorfunction(function):
+                    return this.generator_timer(function, stats_key, stats_label)
+
                 @functools.wraps(function)
                 def wrapper(*args, **kwargs):
+                    if this.resolved_attributes()["aggregate"] and this.do_show():
+                        enter_time = _Peek.perf_counter()
+                        try:
+                            return function(*args, **kwargs)
+                        finally:
+                            _TimerStats.add(stats_key, stats_label, _Peek.perf_counter() - enter_time, this)
+                    if this.resolved_attributes()["tree"] and this.do_show():
+                        _TimerTree.enter(stats_label)
+                        enter_time = _Peek.perf_counter()
+                        try:
+                            return function(*args, **kwargs)
+                        finally:
+                            _TimerTree.exit(this, _Peek.perf_counter() - enter_time)
+                    if not (this.do_show() and this.output_wanted()):
+                        return function(*args, **kwargs)
+                    resolved = this.resolved_attributes()
+                    threshold = resolved["threshold"]
+                    show_enter = resolved["show_enter"] and not threshold
+                    show_exit = resolved["show_exit"]
+                    if show_enter or (show_exit and not threshold):  # the arguments are only rendered if there's a line to output
+                        function_arguments = this.function_arguments(function, args, kwargs)
+
+                    if show_enter:
+                        this.timer_output("called", f"called {function_arguments}", function=function_arguments)
+                    usage = _Usage.start(this) if show_exit else None
                     enter_time = _Peek.perf_counter()
-                    context = this.context()
-
-                    args_kwargs = [repr(arg) for arg in args] + [f"{k}={v!r}" for k, v in kwargs.items()]
-                    function_arguments = f"{function.__name__}({', '.join(args_kwargs)})"
-
-                    if this.show_enter:
-                        this.do_output(f"{context}called {function_arguments}{this.traceback()}")
-                    result = function(*args, **kwargs)
-                    duration = _Peek.perf_counter() - enter_time
-
-                    context = this.context()
-                    if this.show_exit:
-                        this.do_output(f"{context}returned {repr(result)} from {function_arguments} in {duration:.6f} seconds{this.traceback()}")
+                    try:
+                        result = function(*args, **kwargs)
+                    finally:
+                        duration = _Peek.perf_counter() - enter_time
+                        if usage is not None:
+                            usage.stop()
+
+                    if show_exit and (not threshold or duration > threshold):
+                        if threshold:
+                            function_arguments = this.function_arguments(function, args, kwargs)
+                        result_repr = this.argument_repr(result, this.resolved_attributes())
+                        this.timer_output(
+                            "returned",
+                            f"returned {result_repr} from {function_arguments} in {duration:.6f} seconds{_Usage.text(usage, this)}",
+                            function=function_arguments,
+                            result=result_repr,
+                            duration=duration,
+                            **_Usage.fields(usage),
+                        )
 
                     return result
 
@@ -512,92 +849,35 @@ class _Peek:
 
         out = ""
 
-        if args:
-            context = this.context()
-            pairs = []
-            if call_node is None or this.values_only:
-                for right in args:
-                    add_to_pairs(pairs, "", right)
-            else:
-                source = executing.Source.for_frame(call_frame)
-                for node, right in zip(call_node.args, args):
-                    left = source.asttokens().get_text(node)
-                    if lf in left:
-                        left = " " * node.first_token.start[1] + left
-                        left = textwrap.dedent(left)
-                    try:
-                        ast.literal_eval(left)  # it's indeed a literal
-                        left = ""
-                    except Exception:
-                        pass
-                    if left:
-                        try:
-                            if isinstance(left, str):
-                                s = ast.parse(left, mode="eval")
-                            if isinstance(s, ast.Expression):
-                                s = s.body
-                            if s and isinstance(s, ast.JoinedStr):  # it is indeed an f-string
-                                if this.values_only_for_fstrings:
-                                    left = ""
-                        except Exception:
-                            pass
-                    if left:
-                        left += this.equals_separator
-                    add_to_pairs(pairs, left, right)
-
-            just_one_line = False
-
-            if not (len(pairs) > 1 and this.separator == ""):
-                if not any(lf in pair.left for pair in pairs):
-                    as_one_line = context + this.separator.join(pair.left + this.serialize_kwargs(obj=pair.right, width=10000) for pair in pairs)
-                    #                    as_one_line = context + this.separator.join(pair.left + (this.serialize_kwargs(obj=pair.right, width=10000)) for pair in pairs)
-                    if len(as_one_line) <= this.line_length and lf not in as_one_line:
-                        out += as_one_line
-                        just_one_line = True
-
-            if not just_one_line:
-                if isinstance(this.wrap_indent, numbers.Number):
-                    wrap_indent = int(this.wrap_indent) * " "
-                else:
-                    wrap_indent = str(this.wrap_indent)
+        pairs = []
+        if call_site.labels is None or this.values_only:
+            for right in args:
+                add_to_pairs(pairs, "", right)
+        else:
+            for (label, is_fstring), right in zip(call_site.labels, args):
+                if is_fstring and this.values_only_for_fstrings:
+                    label = ""
+                add_to_pairs(pairs, label, right)
 
-                if context.strip():
-                    if len(context.rstrip()) >= len(wrap_indent):
-                        indent1 = wrap_indent
-                        indent1_rest = wrap_indent
-                        lines = [context]
-                    else:
-                        indent1 = context.rstrip().ljust(len(wrap_indent))
-                        indent1_rest = wrap_indent
-                        lines = []
-                else:
-                    indent1 = ""
-                    indent1_rest = ""
-                    lines = []
-
-                for pair in pairs:
-                    do_right = False
-                    if lf in pair.left:
-                        for s in pair.left.splitlines():
-                            lines.append(indent1 + s)
-                            do_right = True
-                    else:
-                        start = indent1 + pair.left
-                        line = start + this.serialize_kwargs(obj=pair.right, width=this.line_length - len(start))
-                        if lf in line:
-                            lines.append(start)
-                            do_right = True
-                        else:
-                            lines.append(line)
-                    indent1 = indent1_rest
-                    if do_right:
-                        indent2 = indent1 + wrap_indent
-                        line = this.serialize_kwargs(obj=pair.right, width=this.line_length - len(indent2))
-                        for s in line.splitlines():
-                            lines.append(indent2 + s)
-                if len(lines) > this.max_lines:
-                    lines = lines[: this.max_lines] + ["[abbreviated]"]
-                out += lf.join(line.rstrip() for line in lines)
+        if this.json_lines:
+            this.use_color = False
+
+        if this.deferred and args and not as_str and not this.to_clipboard:
+            # only a snapshot of the values is taken now, the rendering follows later
+            _Deferred.capture(self, kwargs, this, pairs)
+            return this.return_args(args)
+
+        if this.dedupe and args and not as_str:
+            # the values are compared as serialized on one line, which is reused by the layout
+            if _Repeats.is_repeat(this, call_site, tuple((pair.left, pair.serialized(10000)) for pair in pairs)):
+                return this.return_args(args)
+
+        if this.json_lines:
+            # one JSON object per record, so no layout at all
+            out = this.json_record(values=[[pair.label, pair.serialized(10000)] for pair in pairs])
+
+        elif args:
+            out = this.layout(pairs, this.context())
 
         else:
             if not this.show_line_number:  # if "n" or "no parent", keep that info
@@ -605,7 +885,7 @@ class _Peek:
 
             out += this.context(omit_context_separator=True)
 
-        if this.show_traceback:
+        if this.show_traceback and not this.json_lines:
             out += this.traceback()
 
         if as_str:
@@ -620,11 +900,349 @@ class _Peek:
             return out
 
         if this.to_clipboard:
-            peek.copy_to_clipboard(pairs[-1].right if "pairs" in locals() else "", confirm=False)
+            peek.copy_to_clipboard(pairs[-1].right if pairs else "", confirm=False)
         this.do_output(out)
 
         return this.return_args(args)
 
+    def layout(self, pairs, context):
+        if not (len(pairs) > 1 and self.separator == ""):
+            if not any(lf in pair.left for pair in pairs):
+                as_one_line = context + self.separator.join(pair.left + pair.serialized(10000) for pair in pairs)
+                if len(as_one_line) <= self.line_length and lf not in as_one_line:
+                    return as_one_line
+
+        if isinstance(self.wrap_indent, numbers.Number):
+            wrap_indent = int(self.wrap_indent) * " "
+        else:
+            wrap_indent = str(self.wrap_indent)
+
+        if context.strip():
+            if len(context.rstrip()) >= len(wrap_indent):
+                indent1 = wrap_indent
+                indent1_rest = wrap_indent
+                lines = [context]
+            else:
+                indent1 = context.rstrip().ljust(len(wrap_indent))
+                indent1_rest = wrap_indent
+                lines = []
+        else:
+            indent1 = ""
+            indent1_rest = ""
+            lines = []
+
+        for pair in pairs:
+            do_right = False
+            if lf in pair.left:
+                for s in pair.left.splitlines():
+                    lines.append(indent1 + s)
+                    do_right = True
+            else:
+                start = indent1 + pair.left
+                if pair.serialized.is_multiline(self.line_length - len(start)):
+                    lines.append(start)
+                    do_right = True
+                else:
+                    lines.append(start + pair.serialized(self.line_length - len(start)))
+            indent1 = indent1_rest
+            if do_right:
+                indent2 = indent1 + wrap_indent
+                line = pair.serialized(self.line_length - len(indent2))
+                for s in line.splitlines():
+                    lines.append(indent2 + s)
+        if len(lines) > self.max_lines:
+            lines = lines[: self.max_lines] + ["[abbreviated]"]
+        return lf.join(line.rstrip() for line in lines)
+
+    def timer_output(self, event, text, **fields):
+        # a line of a timer, as text or as a JSON object
+        if self.json_lines:
+            self.do_output(self.json_record(event=event, **fields))
+        else:
+            self.do_output(f"{self.context()}{text}{self.traceback()}")
+
+    def coroutine_timer(self, function, stats_key, stats_label):
+        # the coroutine is timed till completion, both the wall time and the time it was actually running
+        this = self
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if this.resolved_attributes()["aggregate"] and this.do_show():
+                enter_time = _Peek.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    _TimerStats.add(stats_key, stats_label, _Peek.perf_counter() - enter_time, this)
+            if this.resolved_attributes()["tree"] and this.do_show():
+                _TimerTree.enter(stats_label)
+                enter_time = _Peek.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    _TimerTree.exit(this, _Peek.perf_counter() - enter_time)
+            if not (this.do_show() and this.output_wanted()):
+                return await function(*args, **kwargs)
+            resolved = this.resolved_attributes()
+            threshold = resolved["threshold"]
+            show_enter = resolved["show_enter"] and not threshold
+            show_exit = resolved["show_exit"]
+            if show_enter or (show_exit and not threshold):
+                function_arguments = this.function_arguments(function, args, kwargs)
+            if show_enter:
+                this.timer_output("called", f"called {function_arguments}", function=function_arguments)
+            timed = _TimedAwaitable(function(*args, **kwargs))
+            enter_time = _Peek.perf_counter()
+            result = await timed
+            duration = _Peek.perf_counter() - enter_time
+            if show_exit and (not threshold or duration > threshold):
+                if threshold:
+                    function_arguments = this.function_arguments(function, args, kwargs)
+                result_repr = this.argument_repr(result, this.resolved_attributes())
+                this.timer_output(
+                    "returned",
+                    f"returned {result_repr} from {function_arguments} in {duration:.6f} seconds ({timed.running:.6f} seconds running)",
+                    function=function_arguments,
+                    result=result_repr,
+                    duration=duration,
+                    running=timed.running,
+                )
+            return result
+
+        return wrapper
+
+    def async_generator_timer(self, function, stats_key, stats_label):
+        # every item is timed (wall time and running time) and at the end, the totals are output.
+        # With aggregate or tree, nothing is output, but the total wall time of the steps is collected.
+        this = self
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            async_generator = function(*args, **kwargs)
+            proxy = _AsyncGeneratorProxy(async_generator)
+            resolved = this.resolved_attributes()
+            collect = (resolved["aggregate"] or resolved["tree"]) and this.do_show()
+            if not (collect or (this.do_show() and this.output_wanted())):
+                try:
+                    async for item in proxy:
+                        try:
+                            proxy.sent = yield item
+                        except GeneratorExit:
+                            raise
+                        except BaseException as e:
+                            proxy.thrown = e  # passed on to the wrapped generator (with athrow)
+                finally:
+                    await async_generator.aclose()
+                return
+            show_exit = resolved["show_exit"] and not collect
+            if not collect:
+                function_arguments = this.function_arguments(function, args, kwargs)
+                if resolved["show_enter"]:
+                    this.timer_output("called", f"called {function_arguments}", function=function_arguments)
+            items = 0
+            total_duration = 0
+            total_running = 0
+            event = "closed"
+            try:
+                async for item in proxy:
+                    items += 1
+                    total_duration += proxy.duration
+                    total_running += proxy.running
+                    if show_exit:
+                        item_repr = this.argument_repr(item, this.resolved_attributes())
+                        this.timer_output(
+                            "yielded",
+                            f"yielded {item_repr} from {function_arguments} in {proxy.duration:.6f} seconds ({proxy.running:.6f} seconds running)",
+                            function=function_arguments,
+                            item=item_repr,
+                            duration=proxy.duration,
+                            running=proxy.running,
+                        )
+                    try:
+                        proxy.sent = yield item
+                    except GeneratorExit:
+                        raise
+                    except BaseException as e:
+                        proxy.thrown = e  # passed on to the wrapped generator (with athrow)
+                event = "exhausted"
+            except GeneratorExit:
+                raise
+            except BaseException:
+                event = "raised"
+                raise
+            finally:
+                await async_generator.aclose()
+                if event == "exhausted":  # the last step, that found the generator exhausted
+                    total_duration += proxy.duration
+                    total_running += proxy.running
+                if collect:
+                    if resolved["aggregate"]:
+                        _TimerStats.add(stats_key, stats_label, total_duration, this)
+                    else:
+                        _TimerTree.enter(stats_label)
+                        _TimerTree.exit(this, total_duration)
+                elif show_exit:
+                    this.timer_output(
+                        event,
+                        f"{event} {function_arguments} after {items} items in {total_duration:.6f} seconds ({total_running:.6f} seconds running)",
+                        function=function_arguments,
+                        items=items,
+                        duration=total_duration,
+                        running=total_running,
+                    )
+
+        return wrapper
+
+    def generator_timer(self, function, stats_key, stats_label):
+        # the time to produce the items is measured, so not the time the consumer spends between items.
+        # With aggregate or tree, nothing is output, but the total active time is collected.
+        this = self
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            generator = function(*args, **kwargs)
+            resolved = this.resolved_attributes()
+            collect = (resolved["aggregate"] or resolved["tree"]) and this.do_show()
+            if not (collect or (this.do_show() and this.output_wanted())):
+                return (yield from generator)
+            show_exit = resolved["show_exit"] and not collect
+            if not collect:
+                function_arguments = this.function_arguments(function, args, kwargs)
+                if resolved["show_enter"]:
+                    this.timer_output("called", f"called {function_arguments}", function=function_arguments)
+            stats = _TimerStats(stats_label)
+            active = 0
+            first_item = None
+            event = "closed"
+            to_send = None
+            to_throw = None
+            try:
+                while True:
+                    start = _Peek.perf_counter()
+                    try:
+                        item = generator.send(to_send) if to_throw is None else generator.throw(to_throw)
+                    except StopIteration as e:
+                        event = "exhausted"
+                        return e.value
+                    except BaseException:
+                        event = "raised"
+                        raise
+                    finally:
+                        duration = _Peek.perf_counter() - start
+                        active += duration
+                    stats.record(duration)
+                    if first_item is None:
+                        first_item = active
+                    try:
+                        to_send = yield item
+                        to_throw = None
+                    except GeneratorExit:
+                        raise
+                    except BaseException as e:
+                        to_send = None
+                        to_throw = e
+            finally:
+                generator.close()
+                if collect:
+                    if resolved["aggregate"]:
+                        _TimerStats.add(stats_key, stats_label, active, this)
+                    else:
+                        _TimerTree.enter(stats_label)
+                        _TimerTree.exit(this, active)
+                elif show_exit:
+                    fields = dict(function=function_arguments, items=stats.count, active=active)
+                    text = f"{event} {function_arguments} after {stats.count} items in {active:.6f} seconds active"
+                    if stats.count:
+                        fields |= dict(
+                            first_item=first_item,
+                            items_per_second=stats.count / active if active else None,
+                            mean=stats.mean,
+                            p50=stats.percentile(0.5),
+                            p99=stats.percentile(0.99),
+                            max=stats.maximum,
+                        )
+                        items_per_second = f"{stats.count / active:.1f}" if active else "-"
+                        text += (
+                            f" (first item after {first_item:.6f} seconds, {items_per_second} items per second,"
+                            f" per item: mean {stats.mean:.6f}, p50 {fields['p50']:.6f}, p99 {fields['p99']:.6f}, max {stats.maximum:.6f} seconds)"
+                        )
+                    this.timer_output(event, text, **fields)
+
+        return wrapper
+
+    def function_arguments(self, function, args, kwargs):
+        resolved = self.resolved_attributes()
+        args_kwargs = [self.argument_repr(arg, resolved) for arg in args] + [f"{k}={self.argument_repr(v, resolved)}" for k, v in kwargs.items()]
+        return f"{function.__name__}({', '.join(args_kwargs)})"
+
+    def argument_repr(self, obj, resolved):
+        show_args = resolved["show_args"]
+        if show_args == "type":
+            return type(obj).__name__
+        if show_args == "len":
+            try:
+                return f"{type(obj).__name__}(len={len(obj)})"
+            except TypeError:
+                return type(obj).__name__
+        max_arg_items = resolved["max_arg_items"]
+        if max_arg_items:
+            # reprlib only renders the first items of a container, so that's also cheaper for large containers
+            if max_arg_items not in _Peek._limited_reprs:
+                limited_repr = _LimitedRepr()
+                for name in ("maxlist", "maxtuple", "maxdict", "maxset", "maxfrozenset", "maxdeque", "maxarray"):
+                    setattr(limited_repr, name, max_arg_items)
+                limited_repr.maxlevel = limited_repr.maxstring = limited_repr.maxlong = limited_repr.maxother = sys.maxsize
+                _Peek._limited_reprs[max_arg_items] = limited_repr
+            result = _Peek._limited_reprs[max_arg_items].repr(obj)
+        else:
+            result = repr(obj)
+        max_arg_chars = resolved["max_arg_chars"]
+        if max_arg_chars and len(result) > max_arg_chars:
+            result = result[:max_arg_chars] + "..."
+        return result
+
+    def locate(self, call_site):
+        # sets the call site information, as used in the context and in JSON records and returns the parent function part
+        self._call_site = call_site
+        if call_site.qualname in ("", "<module>") or str(self.show_line_number) in ("n", "no parent"):
+            parent_function = ""
+        else:
+            parent_function = f" in {call_site.qualname}()"
+
+        if not call_site.found:
+            self._line_number_with_filename_and_parent = ""
+        else:
+            self._line_number_with_filename_and_parent = f"#{call_site.line_number}{call_site.filename_name}{parent_function}"
+        return parent_function
+
+    def bench(self, function=None, /, *args, **kwargs):
+        # with a function, args and kwargs are passed to that function, otherwise kwargs are attributes (for the with statement)
+        if function is None:
+            this = self.fork(**kwargs)
+            this.locate(_Peek.call_site(real_caller_frame()))
+            return _Bench(this, this._line_number_with_filename_and_parent or "block")
+        this = self.fork()
+        this.locate(_Peek.call_site(real_caller_frame()))
+        bench = _Bench(this, this.function_arguments(function, args, kwargs))
+        bench.finish(*bench.run(function, args, kwargs))
+        return bench.result
+
+    def scaling(self, function, sizes, make_input, target=None):
+        this = self.fork()
+        this.locate(_Peek.call_site(real_caller_frame()))
+        sizes = sorted(set(sizes))
+        if len(sizes) < 3 or sizes[0] < 1:
+            raise ValueError("sizes should contain at least 3 different sizes, all >= 1")
+        label = getattr(function, "__qualname__", repr(function))
+        bench = _Bench(this, label)
+        durations = []
+        for size in sizes:
+            number, round_durations = bench.run(function, (make_input(size),), {})
+            durations.append(min(round_durations))
+        result = _ScalingResult(label, sizes, durations, target)
+        if this.do_show() and this.output_wanted():
+            this.do_output(result.report(this))
+        return result
+
     def timer(self, *args, **kwargs):
         return self(*args, **kwargs | dict(as_timer=True))
 
@@ -634,22 +1252,39 @@ class _Peek:
         yield
         self._attributes = save
 
-    def context(self, omit_line_number=False, omit_context_separator=False):
+    def context(self, omit_line_number=False, omit_context_separator=False, now=None, delta=None):
+        # now and delta are only specified when rendering a deferred record
+        resolved = self.resolved_attributes()
         parts = []
-        if not omit_line_number and self.show_line_number and self._line_number_with_filename_and_parent != "":
+        if not omit_line_number and resolved["show_line_number"] and self._line_number_with_filename_and_parent != "":
             parts.append(self._line_number_with_filename_and_parent)
-        if self.show_time:
-            parts.append(f"@ {str(datetime.datetime.now().strftime('%H:%M:%S.%f'))}")
+        if resolved["show_time"]:
+            parts.append(f"@ {str((now or datetime.datetime.now()).strftime('%H:%M:%S.%f'))}")
 
-        if self.show_delta:
-            parts.append(f"delta={self.delta:.3f}")
+        if resolved["show_delta"]:
+            parts.append(f"delta={self.delta if delta is None else delta:.3f}")
 
         context = " ".join(parts)
         if not omit_context_separator and context:
-            context += self.context_separator
+            context += resolved["context_separator"]
 
         return f"{self.prefix}{context}"
 
+    def json_record(self, **fields):
+        call_site = vars(self).get("_call_site")  # not available for e.g. timer_report
+        record = dict(
+            timestamp=datetime.datetime.now().isoformat(),
+            perf_counter=_Peek.perf_counter(),
+            pid=os.getpid(),
+            thread=threading.current_thread().name,
+            file=call_site and call_site.filename,
+            line=call_site and call_site.line_number,
+            qualname=call_site and call_site.qualname,
+            level=self.level,
+        )
+        record.update(fields)
+        return json.dumps(record, default=repr)
+
     def add_color_value(self, s):
         if not self.use_color:
             return s
@@ -666,49 +1301,108 @@ class _Peek:
             return f"{_Peek._color_name_to_ANSI[self.color_value]}{s}{_Peek._color_name_to_ANSI[self.color]}"
 
     def do_output(self, s):
-        if self.use_color and self.color not in ("", "-"):
-            s_end = f"{_Peek._color_name_to_ANSI[self.color.lower()]}{s}{_Peek._color_name_to_ANSI['-']}"
-            if self.end == lf:
+        resolved = self.resolved_attributes()
+        output = resolved["output"]
+        end = resolved["end"]
+        if resolved["use_color"] and resolved["color"] not in ("", "-") and not resolved["json_lines"]:
+            color = resolved["color"].lower()
+            s_end = f"{_Peek._color_name_to_ANSI[color]}{s}{_Peek._color_name_to_ANSI['-']}"
+            if end == lf:
                 s_end += lf
             else:
-                s_end += f"{_Peek._color_name_to_ANSI[self.color.lower()]}{self.end}{_Peek._color_name_to_ANSI['-']}"
+                s_end += f"{_Peek._color_name_to_ANSI[color]}{end}{_Peek._color_name_to_ANSI['-']}"
+        else:
+            s_end = f"{s}{end}"
+
+        if resolved["async_output"] and threading.current_thread() is not _AsyncWriter.thread:
+            _AsyncWriter.put(
+                (_Peek.write_output, output, s, s_end, resolved["buffer_size"], resolved["flush_interval"]), resolved["queue_size"], resolved["overflow"]
+            )
         else:
-            s_end = f"{s}{self.end}"
+            _Peek.write_output(output, s, s_end, resolved["buffer_size"], resolved["flush_interval"])
 
-        if callable(self.output):
-            if self.output == builtins.print or "end" in inspect.signature(self.output).parameters:
-                # test for builtins.print is required as for Python <= 3.10, builtins.print has no signature
-                self.output(s_end, end="")
+    @staticmethod
+    def write_output(output, s, s_end, buffer_size, flush_interval):
+        if isinstance(output, str) and ":" in output and _Peek.logging_target(output) is not None:
+            logger, level = _Peek.logging_target(output)
+            logger.log(level, s)
+        elif callable(output):
+            if _Peek.logging_target(output) is not None:
+                output(s)
+            elif "end" in _Peek.accepted_parameters(output):
+                output(s_end, end="")
             else:
-                self.output(s_end)
-        elif self.output in ("stdout", "stderr"):
-            file = sys.stdout if self.output == "stdout" else sys.stderr
+                output(s_end)
+        elif output in ("stdout", "stderr"):
+            file = sys.stdout if output == "stdout" else sys.stderr
             if Pythonista:
                 _Peek.print_pythonista_color(s_end, end="", file=file)
             # elif Pyodide:  # not handled via use_color
             #     _Peek.print_without_color(s, end=self.end, file=file)
             else:
                 print(s_end, end="", file=file)
-        elif self.output == "logging.debug":
+        elif output == "logging.debug":
             logging.debug(s)
-        elif self.output == "logging.info":
+        elif output == "logging.info":
             logging.info(s)
-        elif self.output == "logging.warning":
+        elif output == "logging.warning":
             logging.warning(s)
-        elif self.output == "logging.error":
+        elif output == "logging.error":
             logging.error(s)
-        elif self.output == "logging.critical":
+        elif output == "logging.critical":
             logging.critical(s)
-        elif self.output in ("", "null"):
+        elif output in ("", "null"):
             pass
-        elif isinstance(self.output, str):
-            with open(self.output, "a+", encoding="utf-8") as f:
-                print(s_end, file=f, end="")
-        elif isinstance(self.output, Path):
-            with self.output.open("a+", encoding="utf-8") as f:
-                print(s_end, file=f, end="")
+        elif isinstance(output, (str, Path)):
+            _FileSink.get(output, buffer_size).write(s_end, flush_interval)
         else:
-            print(s_end, file=self.output, end="")
+            print(s_end, file=output, end="")
+
+    @staticmethod
+    def logging_target(output):
+        # returns the logger and level if output is a logging target, otherwise None
+        if isinstance(output, str):
+            if not output.startswith("logging."):
+                return None
+            if output not in _Peek._logging_targets:
+                # logging.getLogger always returns the same logger for a name, so the target can be cached
+                level_name, _, logger_name = output[len("logging.") :].partition(":")
+                if level_name in _Peek._logging_levels:
+                    _Peek._logging_targets[output] = logging.getLogger(logger_name or None), _Peek._logging_levels[level_name]
+                else:
+                    _Peek._logging_targets[output] = None
+            return _Peek._logging_targets[output]
+        logger = getattr(output, "__self__", None)
+        if isinstance(logger, (logging.Logger, logging.LoggerAdapter)) and getattr(output, "__name__", "") in _Peek._logging_levels:
+            return logger, _Peek._logging_levels[output.__name__]
+        return None
+
+    @staticmethod
+    def logging_enabled(output):
+        # False if output is a logging target that would discard the record anyway
+        logging_target = _Peek.logging_target(output)
+        return logging_target is None or logging_target[0].isEnabledFor(logging_target[1])
+
+    def output_wanted(self):
+        return _Peek.logging_enabled(self.resolved_attributes()["output"])
+
+    def dropped_records(self):
+        return dict(drop_oldest=_AsyncWriter.dropped_oldest, drop_newest=_AsyncWriter.dropped_newest)
+
+    def timer_report(self, as_str=False):
+        out = _TimerStats.report(self)
+        if as_str:
+            return out + self.end if out else ""
+        if out:
+            self.do_output(out)
+
+    def suppressed_records(self):
+        # per line, so the counts of several call sites on one line are summed
+        records = {}
+        for throttle in list(_Throttle.throttles.values()):
+            key = f"{throttle.call_site.filename}:{throttle.call_site.line_number}"
+            records[key] = records.get(key, 0) + throttle.suppressed
+        return records
 
     def copy_to_clipboard(self, value, confirm=True):
         if Pythonista:
@@ -735,12 +1429,25 @@ class _Peek:
             else:
                 raise SystemExit("stopped by peek.stop")
 
-    def traceback(self):
-        if self.show_traceback:
-            if self.show_traceback is True:
+    @staticmethod
+    def capture_stack():
+        # a cheap alternative for traceback.extract_stack, as only the code objects and line numbers are collected.
+        # The source lines are only looked up when the stack is rendered by traceback.
+        stack = []
+        frame = sys._getframe(1)
+        while frame is not None:
+            stack.append(traceback.FrameSummary(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name, lookup_line=False))
+            frame = frame.f_back
+        return stack[::-1]
+
+    def traceback(self, stack=None):
+        # stack is a stack as captured earlier by capture_stack (otherwise, the current stack is used)
+        show_traceback = self.resolved_attributes()["show_traceback"]
+        if show_traceback:
+            if show_traceback is True:
                 n = 1_000_000
             else:
-                n = self.show_traceback
+                n = show_traceback
             if isinstance(self.wrap_indent, numbers.Number):
                 wrap_indent = int(self.wrap_indent) * " "
             else:
@@ -748,7 +1455,7 @@ class _Peek:
 
             result = ["", f"{wrap_indent}Traceback (most recent call last)"]
             entries = []
-            for entry in traceback.extract_stack()[::-1]:
+            for entry in (traceback.extract_stack() if stack is None else stack)[::-1]:
                 filename = Path(entry.filename).name
                 if filename != "peek.py":  # this is for timer and  pytest, which adds two extra levels
                     entries.append(entry)
@@ -765,6 +1472,11 @@ class _Peek:
             return ""
 
     def serialize_kwargs(self, obj, width):
+        return self.serialize_at(obj, width)[0]
+
+    def serialize_at(self, obj, width):
+        # returns the serialized obj and the minimal width from which the same serialization would result
+        # for any width (None if that's not known)
         if self.format:
             if isinstance(self.format, str):
                 iterator = iter([self.format])
@@ -773,25 +1485,35 @@ class _Peek:
             for sub_format in iterator:
                 format_string = "{" + sub_format + "}" if sub_format.startswith(":") or sub_format.startswith("!") else "{:" + sub_format + "}"
                 try:
-                    return format_string.format(obj)
+                    return format_string.format(obj), 0
                 except Exception:
                     ...
         if isinstance(obj, str):
             if not self.quote_string:
-                return str(self.add_color_value(obj))
-        kwargs = {
-            key: getattr(self, key)
-            for key in ("sort_dicts", "compact", "indent", "depth", "underscore_numbers")
-            if key in inspect.signature(self.serialize).parameters
-        }
-        if "width" in inspect.signature(self.serialize).parameters:
+                return str(self.add_color_value(obj)), 0
+        parameters = _Peek.accepted_parameters(self.serialize)
+        kwargs = {key: getattr(self, key) for key in ("sort_dicts", "compact", "indent", "depth", "underscore_numbers") if key in parameters}
+        if "width" in parameters:
             kwargs["width"] = width
         try:
             serialized = self.serialize(obj, **kwargs)
         except TypeError:
             kwargs["sort_dicts"] = False  # try without sorting (sometimes required for sympy)
             serialized = self.serialize(obj, **kwargs)
-        return self.add_color_value(serialized.replace("\\n", "\n"))
+        if "width" not in parameters:
+            valid_from = 0
+        elif self.serialize is pprint.pformat and len(serialized) <= width and lf not in serialized:
+            valid_from = len(serialized)  # pprint.pformat returns the plain representation whenever that fits
+        else:
+            valid_from = None
+        return self.add_color_value(serialized.replace("\\n", "\n")), valid_from
+
+    def flush(self):
+        _Repeats.report_all()
+        _Deferred.render_all()
+        _AsyncWriter.drain()
+        _RecordFile.flush_all()
+        _FileSink.flush_all()
 
     def reset(self):
         reset()
@@ -811,6 +1533,14 @@ def reset():
     global _peek_toml
     global peek
 
+    _Throttle.throttles.clear()
+    _TimerStats.stats.clear()
+    _Repeats.report_all()
+    _Repeats.sites.clear()
+    _Deferred.render_all()
+    _AsyncWriter.drain()
+    _RecordFile.close_all()
+    _FileSink.close_all()
     _Peek.in_read_toml_message = ""
     _peek_no_toml = _Peek(**_Peek.name_default)
     _peek_toml = _Peek(**(_Peek.name_default | _Peek.read_toml()))
@@ -819,6 +1549,865 @@ def reset():
     builtins.peek = peek
 
 
+class _AsyncWriter:
+    # a daemon thread that writes the records from a bounded queue, so the calling threads never wait for the output.
+    # As there's only one queue and one writer, the order of the records of each thread is maintained.
+
+    records = collections.deque()
+    condition = threading.Condition()
+    thread = None
+    busy = False
+    dropped_oldest = 0
+    dropped_newest = 0
+
+    @staticmethod
+    def put(record, queue_size, overflow):
+        with _AsyncWriter.condition:
+            if _AsyncWriter.thread is None or not _AsyncWriter.thread.is_alive():
+                _AsyncWriter.thread = threading.Thread(target=_AsyncWriter.run, name="peek writer", daemon=True)
+                _AsyncWriter.thread.start()
+            while len(_AsyncWriter.records) >= queue_size:
+                if overflow == "drop_newest":
+                    _AsyncWriter.dropped_newest += 1
+                    return
+                if overflow == "drop_oldest":
+                    _AsyncWriter.records.popleft()
+                    _AsyncWriter.dropped_oldest += 1
+                else:
+                    _AsyncWriter.condition.wait()
+            _AsyncWriter.records.append(record)
+            _AsyncWriter.condition.notify_all()
+
+    @staticmethod
+    def run():
+        while True:
+            with _AsyncWriter.condition:
+                while not _AsyncWriter.records:
+                    _AsyncWriter.condition.wait()
+                record = _AsyncWriter.records.popleft()
+                _AsyncWriter.busy = True
+                _AsyncWriter.condition.notify_all()
+            try:
+                record[0](*record[1:])
+            except Exception:
+                traceback.print_exc()
+            with _AsyncWriter.condition:
+                _AsyncWriter.busy = False
+                _AsyncWriter.condition.notify_all()
+
+    @staticmethod
+    def drain():
+        # waits until all queued records are written
+        if _AsyncWriter.thread is None or threading.current_thread() is _AsyncWriter.thread:
+            return
+        with _AsyncWriter.condition:
+            while (_AsyncWriter.records or _AsyncWriter.busy) and _AsyncWriter.thread.is_alive():
+                _AsyncWriter.condition.wait(0.1)
+
+
+class _FileSink:
+    # a file output that is kept open, rather than opened and closed for every record.
+    # It's flushed at most every flush_interval seconds: if a record is not flushed when written, a (daemon) timer
+    # flushes it when the interval has passed, so the last records of a burst don't stay in the buffer.
+    # It's also flushed with peek.flush(), reset(), at exit and when output is reconfigured.
+
+    sinks = {}
+    lock = threading.Lock()
+
+    def __init__(self, path, buffer_size):
+        self.buffer_size = buffer_size
+        self.file = open(path, "a", encoding="utf-8", buffering=buffer_size)
+        self.last_flush = time.perf_counter()
+        self.flush_timer = None
+
+    @staticmethod
+    def get(path, buffer_size):
+        # the path is resolved on every write, so a relative path follows any change of the working directory
+        # An open sink keeps its buffer size: reopening the file whenever calls with another buffer_size alternate
+        # would defeat the buffering (and a second sink for the same file would interleave the records).
+        key = os.path.abspath(path)
+        sink = _FileSink.sinks.get(key)
+        if sink is None:
+            with _FileSink.lock:
+                sink = _FileSink.sinks.get(key)  # another thread might have created the sink in the meantime
+                if sink is None:
+                    sink = _FileSink.sinks[key] = _FileSink(key, buffer_size)
+        return sink
+
+    def write(self, s, flush_interval):
+        with _FileSink.lock:
+            self.file.write(s)
+            now = time.perf_counter()
+            if now - self.last_flush >= flush_interval:
+                self.flush(now)
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(flush_interval - (now - self.last_flush), self.flush_by_timer)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self, now):
+        # should be called with the lock acquired
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        self.file.flush()
+        self.last_flush = now
+
+    def flush_by_timer(self):
+        with _FileSink.lock:
+            if self.flush_timer is not None and not self.file.closed:
+                self.flush_timer = None
+                self.file.flush()
+                self.last_flush = time.perf_counter()
+
+    def close(self):
+        # should be called with the lock acquired
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        self.file.close()
+
+    @staticmethod
+    def flush_all():
+        with _FileSink.lock:
+            for sink in _FileSink.sinks.values():
+                sink.flush(time.perf_counter())
+
+    @staticmethod
+    def close_all():
+        with _FileSink.lock:
+            for sink in _FileSink.sinks.values():
+                sink.close()
+            _FileSink.sinks.clear()
+
+
+class _TimerStats:
+    # the statistics of the durations of an aggregating timer: count, total, minimum, maximum, mean and
+    # standard deviation (with Welford's algorithm) and a histogram with logarithmic buckets (8 per factor 2,
+    # so about 9% wide) for the percentiles. So the memory usage doesn't grow with the number of calls.
+
+    stats = {}
+    lock = threading.Lock()
+    last_report = None
+    peek = None
+    collected_since_report = False  # so the report at exit is skipped if nothing was collected since the last report
+    buckets_per_octave = 8
+
+    def __init__(self, label, call_site=None):
+        self.label = label
+        self.call_site = call_site  # for a with block, holds the code object, so the id in the key can't be reused
+        self.count = 0
+        self.total = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.mean = 0
+        self.m2 = 0
+        self.histogram = collections.Counter()
+
+    @staticmethod
+    def add(key, label, duration, this, call_site=None):
+        with _TimerStats.lock:
+            stats = _TimerStats.stats.get(key)
+            if stats is None:
+                if len(_TimerStats.stats) >= _Peek._call_sites_max:
+                    # the keys hold code objects (or, for with blocks, their ids), so this is bounded for code that's generated on the fly
+                    _TimerStats.stats.pop(next(iter(_TimerStats.stats)))  # the oldest entry
+                stats = _TimerStats.stats[key] = _TimerStats(label, call_site)
+            stats.record(duration)
+            _TimerStats.peek = this  # for the report at exit
+            _TimerStats.collected_since_report = True
+
+        report_interval = this.resolved_attributes()["report_interval"]
+        if report_interval:
+            now = _Peek.perf_counter()
+            if _TimerStats.last_report is None:
+                _TimerStats.last_report = now
+            elif now - _TimerStats.last_report >= report_interval:
+                _TimerStats.last_report = now
+                this.timer_report()
+
+    def record(self, duration):
+        self.count += 1
+        self.total += duration
+        self.minimum = min(self.minimum, duration)
+        self.maximum = max(self.maximum, duration)
+        delta = duration - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (duration - self.mean)
+        self.histogram[math.floor(math.log2(duration) * _TimerStats.buckets_per_octave) if duration > 0 else None] += 1
+
+    def stddev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0
+
+    def percentile(self, fraction):
+        # the geometric mean of the bounds of the bucket, but never outside the observed range
+        needed = fraction * self.count
+        cumulative = self.histogram.get(None, 0)
+        if cumulative >= needed:
+            return self.minimum
+        for bucket in sorted(bucket for bucket in self.histogram if bucket is not None):
+            cumulative += self.histogram[bucket]
+            if cumulative >= needed:
+                return min(max(2 ** ((bucket + 0.5) / _TimerStats.buckets_per_octave), self.minimum), self.maximum)
+        return self.maximum
+
+    @staticmethod
+    def report(this):
+        with _TimerStats.lock:
+            all_stats = [copy.deepcopy(stats) for stats in _TimerStats.stats.values()]
+            _TimerStats.collected_since_report = False
+        if not all_stats:
+            return ""
+        columns = ("total", "mean", "stddev", "min", "p50", "p90", "p99", "max")
+        rows = []
+        for stats in all_stats:
+            values = (
+                stats.total,
+                stats.mean,
+                stats.stddev(),
+                stats.minimum,
+                stats.percentile(0.5),
+                stats.percentile(0.9),
+                stats.percentile(0.99),
+                stats.maximum,
+            )
+            rows.append((stats.label, stats.count, values))
+        if this.json_lines:
+            return lf.join(this.json_record(event="timer_report", timer=label, count=count, **dict(zip(columns, values))) for label, count, values in rows)
+        # the total is shown in seconds, the other durations in microseconds
+        label_width = max(len("timer"), *(len(label) for label, count, values in rows))
+        headers = ["total(s)"] + [f"{column}(us)" for column in columns[1:]]
+        lines = [f"{this.prefix}{'timer':{label_width}} {'count':>10}" + "".join(f" {header:>12}" for header in headers)]
+        for label, count, (total, *values) in rows:
+            lines.append(f"{this.prefix}{label:{label_width}} {count:10d} {total:12.6f}" + "".join(f" {value * 1e6:12.3f}" for value in values))
+        return lf.join(lines)
+
+    @staticmethod
+    def report_at_exit():
+        if _TimerStats.stats and _TimerStats.collected_since_report:
+            _TimerStats.peek.timer_report()
+
+
+class _BenchResult:
+    def __init__(self, label, number, durations):
+        self.label = label
+        self.number = number  # loops per round
+        self.durations = durations  # per loop, for every round
+        self.min = min(durations)
+        self.median = statistics.median(durations)
+        if len(durations) >= 2:
+            quartiles = statistics.quantiles(durations, n=4)
+            self.iqr = quartiles[2] - quartiles[0]
+        else:
+            self.iqr = 0
+        self.ops_per_second = 1 / self.median if self.median > 0 else math.inf
+
+    def __repr__(self):
+        return (
+            f"BenchResult(label={self.label!r}, min={self.min!r}, median={self.median!r}, iqr={self.iqr!r},"
+            f" ops_per_second={self.ops_per_second!r}, number={self.number!r}, repeat={len(self.durations)!r})"
+        )
+
+
+class _Bench:
+    # a microbenchmark like timeit: the number of loops is doubled until a round takes at least min_time (that's also the warmup),
+    # then one more warmup round and repeat timed rounds, with the garbage collector disabled.
+    # The overhead of the loop itself (measured without any work) is subtracted.
+
+    def __init__(self, this, label):
+        self.this = this
+        self.label = label
+        resolved = this.resolved_attributes()
+        self.repeat = resolved["repeat"]
+        self.min_time = resolved["min_time"]
+        self.result = None
+        self.gc_enabled = None
+
+    @staticmethod
+    def nothing(*args, **kwargs):
+        pass
+
+    @staticmethod
+    def nothing_loop(number):
+        for _ in range(number):
+            yield
+
+    def disable_gc(self):
+        self.gc_enabled = gc.isenabled()
+        gc.disable()
+
+    def restore_gc(self):
+        if self.gc_enabled:
+            gc.enable()
+        self.gc_enabled = None
+
+    def run(self, function, args, kwargs):
+        def timed_round(function, number):
+            start = time.perf_counter()
+            for _ in range(number):
+                function(*args, **kwargs)
+            return time.perf_counter() - start
+
+        self.disable_gc()
+        try:
+            number = 1
+            while timed_round(function, number) < self.min_time:
+                number *= 2
+            timed_round(function, number)
+            overhead = min(timed_round(_Bench.nothing, number) for _ in range(3)) / number
+            durations = [max(0, timed_round(function, number) / number - overhead) for _ in range(self.repeat)]
+        finally:
+            self.restore_gc()
+        return number, durations
+
+    def __enter__(self):
+        return self
+
+    def __iter__(self):
+        # the body of the with statement iterates over this, so the body is executed as often as required
+        self.disable_gc()
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                yield
+            if time.perf_counter() - start >= self.min_time:
+                break
+            number *= 2
+        for _ in range(number):
+            yield
+        overheads = []
+        for _ in range(3):
+            start = time.perf_counter()
+            for _ in _Bench.nothing_loop(number):
+                pass
+            overheads.append(time.perf_counter() - start)
+        overhead = min(overheads) / number
+        durations = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                yield
+            durations.append(max(0, (time.perf_counter() - start) / number - overhead))
+        self.restore_gc()
+        self.number = number
+        self.durations = durations
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.restore_gc()
+        if exc_type is None:
+            if not hasattr(self, "durations"):  # the body didn't iterate (completely) over the bench object
+                raise TypeError("the body of with peek.bench() should iterate over the bench object, like for _ in b: ...")
+            self.finish(self.number, self.durations)
+
+    def finish(self, number, durations):
+        self.result = result = _BenchResult(self.label, number, durations)
+        this = self.this
+        if this.do_show() and this.output_wanted():
+            this.timer_output(
+                "bench",
+                f"bench {self.label}: min {_Bench.format_duration(result.min)}, median {_Bench.format_duration(result.median)},"
+                f" IQR {_Bench.format_duration(result.iqr)}, {result.ops_per_second:,.0f} ops/s ({len(durations)} rounds of {number} loops)",
+                function=self.label,
+                min=result.min,
+                median=result.median,
+                iqr=result.iqr,
+                ops_per_second=result.ops_per_second,
+                number=number,
+                repeat=len(durations),
+            )
+
+    @staticmethod
+    def format_duration(duration):
+        for unit, factor in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+            if duration >= factor:
+                return f"{duration / factor:.3f} {unit}"
+        return f"{duration / 1e-9:.3f} ns"
+
+
+class _ScalingResult:
+    # the durations for a number of input sizes, fitted against t = a + b * f(n) for every model,
+    # with weights 1/t**2, so the relative (rather than absolute) errors are minimized
+
+    models = {
+        "O(1)": None,
+        "O(log n)": math.log,
+        "O(n)": lambda n: n,
+        "O(n log n)": lambda n: n * math.log(n),
+        "O(n^2)": lambda n: n * n,
+    }
+
+    def __init__(self, label, sizes, durations, target=None):
+        self.label = label
+        self.sizes = sizes
+        self.durations = durations
+        self.fits = _ScalingResult.fit(sizes, durations)
+        self.best = _ScalingResult.best_fit(self.fits)
+        self.r_squared = self.fits[self.best][2]
+        self.target = target
+        self.predicted = None if target is None else self.predict(target)
+
+    @staticmethod
+    def fit(sizes, durations):
+        # returns a dict with per model a tuple of a, b and the (weighted) coefficient of determination
+        weights = [1 / max(duration, 1e-12) ** 2 for duration in durations]
+        sum_w = sum(weights)
+        mean = sum(w * t for w, t in zip(weights, durations)) / sum_w
+        ss_total = sum(w * (t - mean) ** 2 for w, t in zip(weights, durations))
+        fits = {}
+        for model, f in _ScalingResult.models.items():
+            if f is None:
+                fits[model] = (mean, 0.0, 0.0)
+                continue
+            xs = [f(size) for size in sizes]
+            sum_x = sum(w * x for w, x in zip(weights, xs))
+            sum_y = sum(w * t for w, t in zip(weights, durations))
+            sum_xx = sum(w * x * x for w, x in zip(weights, xs))
+            sum_xy = sum(w * x * t for w, x, t in zip(weights, xs, durations))
+            denominator = sum_w * sum_xx - sum_x * sum_x
+            if denominator <= 0:
+                fits[model] = (mean, 0.0, 0.0)
+                continue
+            b = (sum_w * sum_xy - sum_x * sum_y) / denominator
+            a = (sum_y - b * sum_x) / sum_w
+            ss_residual = sum(w * (t - a - b * x) ** 2 for w, x, t in zip(weights, xs, durations))
+            fits[model] = (a, b, 1 - ss_residual / ss_total if ss_total > 0 else 0.0)
+        return fits
+
+    @staticmethod
+    def best_fit(fits):
+        # the growing model (b > 0) with the highest R^2, provided that explains at least half of the variance; otherwise O(1)
+        candidates = [(r_squared, model) for model, (a, b, r_squared) in fits.items() if b > 0]
+        if candidates:
+            r_squared, model = max(candidates)
+            if r_squared >= 0.5:
+                return model
+        return "O(1)"
+
+    def predict(self, size, model=None):
+        a, b, _ = self.fits[model or self.best]
+        f = _ScalingResult.models[model or self.best]
+        return a if f is None else a + b * f(size)
+
+    def report(self, this):
+        if this.json_lines:
+            return this.json_record(
+                event="scaling",
+                function=self.label,
+                sizes=self.sizes,
+                durations=self.durations,
+                best=self.best,
+                r_squared={model: r_squared for model, (_, _, r_squared) in self.fits.items()},
+                target=self.target,
+                predicted=self.predicted,
+            )
+        line = f"scaling {self.label}: best fit {self.best} (R^2={self.r_squared:.4f})"
+        if self.target is not None:
+            line += f", predicted {self.predicted:.6f} seconds for n={self.target:,}"
+        lines = [f"{this.context()}{line}"]
+        lines.append(f"{this.prefix}{'n':>15} {'time(s)':>14} {'fit(s)':>14}")
+        for size, duration in zip(self.sizes, self.durations):
+            lines.append(f"{this.prefix}{size:15,} {duration:14.9f} {self.predict(size):14.9f}")
+        lines.append(f"{this.prefix}R^2: " + ", ".join(f"{model} {r_squared:.4f}" for model, (_, _, r_squared) in self.fits.items()))
+        return lf.join(lines)
+
+    def __repr__(self):
+        return f"ScalingResult(label={self.label!r}, best={self.best!r}, r_squared={self.r_squared!r}, predicted={self.predicted!r})"
+
+
+class _TimerTree:
+    # with tree, the timers that are active in a thread (or asyncio task) form a stack. The durations are collected in a tree
+    # (with the same timers under the same parent combined), that is output when the outermost timer exits.
+    # The stack is a tuple in a context variable, so concurrent tasks on one thread have their own stack
+    # (and a task that's created within a timer inherits the stack).
+
+    stack = contextvars.ContextVar("peek_timer_tree_stack", default=())
+
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.cumulative = 0
+        self.children = {}
+
+    @staticmethod
+    def enter(label):
+        stack = _TimerTree.stack.get()
+        if stack:
+            children = stack[-1].children
+            if label not in children:
+                children[label] = _TimerTree(label)
+            _TimerTree.stack.set(stack + (children[label],))
+        else:
+            _TimerTree.stack.set((_TimerTree(label),))
+
+    @staticmethod
+    def exit(this, duration):
+        *stack, node = _TimerTree.stack.get()
+        _TimerTree.stack.set(tuple(stack))
+        node.count += 1
+        node.cumulative += duration
+        if not stack:
+            this.do_output(node.report(this))
+
+    def self_time(self):
+        return self.cumulative - sum(child.cumulative for child in self.children.values())
+
+    def nodes(self, depth=0, parent=None):
+        # yields all nodes of the tree (depth first) with their depth and parent
+        yield self, depth, parent
+        for child in self.children.values():
+            yield from child.nodes(depth + 1, self)
+
+    def report(self, this):
+        rows = []
+        for node, depth, parent in self.nodes():
+            share = 100 * node.cumulative / parent.cumulative if parent is not None and parent.cumulative else None
+            rows.append((node.label, depth, node.count, node.cumulative, node.self_time(), share))
+        if this.json_lines:
+            return lf.join(
+                this.json_record(event="timer_tree", timer=label, depth=depth, count=count, cumulative=cumulative, self_time=self_time, parent_percentage=share)
+                for label, depth, count, cumulative, self_time, share in rows
+            )
+        labels = [f"{'    ' * depth}{label}" for label, depth, *_ in rows]
+        label_width = max(len("timer tree"), *(len(label) for label in labels))
+        lines = [f"{this.prefix}{'timer tree':{label_width}} {'count':>10} {'cumulative(s)':>14} {'self(s)':>12} {'parent(%)':>10}"]
+        for label, (_, _, count, cumulative, self_time, share) in zip(labels, rows):
+            share = "" if share is None else f"{share:10.1f}"
+            lines.append(f"{this.prefix}{label:{label_width}} {count:10d} {cumulative:14.6f} {self_time:12.6f} {share:>10}".rstrip())
+        return lf.join(lines)
+
+
+class _Throttle:
+    # the state of every, sample and max_per_second for one call site (so not per line, as a line might contain several peek calls).
+    # Like the call site cache, the number of call sites is bounded; the suppressed calls of an evicted call site are reported.
+
+    throttles = {}
+    lock = threading.Lock()
+
+    def __init__(self, call_site):
+        self.call_site = call_site
+        self.calls = 0
+        self.suppressed = 0
+        self.tokens = None
+        self.last_refill = 0
+        self.peek = None
+
+    @staticmethod
+    def get(call_site):
+        throttle = _Throttle.throttles.get(call_site.key)
+        if throttle is None:
+            evicted = None
+            with _Throttle.lock:
+                throttle = _Throttle.throttles.get(call_site.key)
+                if throttle is None:
+                    if len(_Throttle.throttles) >= _Peek._call_sites_max:
+                        evicted = _Throttle.throttles.pop(next(iter(_Throttle.throttles)))  # the oldest entry
+                    throttle = _Throttle.throttles[call_site.key] = _Throttle(call_site)
+            if evicted is not None:
+                evicted.report_suppressed()
+        return throttle
+
+    def allows(self, this, resolved):
+        with _Throttle.lock:
+            self.calls += 1
+            if self.allows_call(resolved):
+                return True
+            self.suppressed += 1
+            self.peek = this  # for the report at exit
+            return False
+
+    def allows_call(self, resolved):
+        every = resolved["every"]
+        if every != 1 and (self.calls - 1) % every:
+            return False
+        sample = resolved["sample"]
+        if sample != 1:
+            sample_key = resolved["sample_key"]
+            if sample_key == "":
+                fraction = random.random()
+            else:
+                fraction = zlib.crc32(repr(sample_key).encode()) / 2**32  # the same for every run (unlike hash)
+            if fraction >= sample:
+                return False
+        max_per_second = resolved["max_per_second"]
+        if max_per_second:
+            # a token bucket, that holds at most one second's worth of tokens (and at least one)
+            now = _Peek.perf_counter()
+            capacity = max(1, max_per_second)
+            if self.tokens is None:
+                self.tokens = capacity
+            else:
+                self.tokens = min(capacity, self.tokens + (now - self.last_refill) * max_per_second)
+            self.last_refill = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        return True
+
+    def report_suppressed(self):
+        if self.suppressed:
+            this = self.peek
+            if this.json_lines:
+                this.do_output(this.json_record(event="suppressed", suppressed=self.suppressed, calls=self.calls))
+            else:
+                location = this._line_number_with_filename_and_parent or self.call_site.filename  # e.g. <string> for exec
+                this.do_output(f"{this.prefix}{location}{this.context_separator}suppressed {self.suppressed} of {self.calls} calls")
+            self.suppressed = 0
+            self.calls = 0
+
+    @staticmethod
+    def report():
+        for throttle in list(_Throttle.throttles.values()):
+            throttle.report_suppressed()
+
+
+class _Repeats:
+    # with dedupe, the last record of every call site and the number of times it was repeated since it was output.
+    # Like the call site cache, the number of call sites is bounded; the repeats of an evicted call site are reported.
+
+    sites = {}
+    lock = threading.Lock()
+
+    def __init__(self, call_site, key, now):
+        self.call_site = call_site  # holds the code object, so the id in the site key can't be reused
+        self.key = key
+        self.first_time = now
+        self.last_time = now
+        self.repeats = 0
+        self.peek = None
+
+    @staticmethod
+    def is_repeat(this, call_site, key):
+        now = _Peek.perf_counter()
+        site_key = call_site.key  # so several peek calls on one line are kept apart
+        with _Repeats.lock:
+            site = _Repeats.sites.get(site_key)
+            if site is not None and site.key == key:
+                site.repeats += 1
+                site.last_time = now
+                site.peek = this
+                return True
+            evicted = None
+            if site is None and len(_Repeats.sites) >= _Peek._call_sites_max:
+                evicted = _Repeats.sites.pop(next(iter(_Repeats.sites)))  # the oldest entry
+            _Repeats.sites[site_key] = _Repeats(call_site, key, now)
+        for site in (site, evicted):
+            if site is not None:
+                site.report()
+        return False
+
+    def report(self):
+        if self.repeats:
+            this = self.peek
+            duration = self.last_time - self.first_time
+            if this.json_lines:
+                this.do_output(this.json_record(event="repeated", repeats=self.repeats, duration=duration))
+            else:
+                this.do_output(f"{this.context()}... repeated {self.repeats:,} times over {duration:.1f}s")
+
+    @staticmethod
+    def report_all():
+        # the repeats so far are reported, but a next identical record is still a repeat
+        with _Repeats.lock:
+            sites = list(_Repeats.sites.values())
+            reported = []
+            for site in sites:
+                if site.repeats:
+                    reported.append(copy.copy(site))
+                    site.repeats = 0
+                    site.first_time = site.last_time
+        for site in reported:
+            site.report()
+
+
+class _Snapshot:
+    # stands for a captured value that can't be restored, so it's rendered as captured
+    def __init__(self, representation):
+        self.representation = representation
+
+    def __repr__(self):
+        return self.representation
+
+
+class _Deferred:
+    # peek calls with deferred=True (or a path) take only a snapshot of the values (by default their repr) and a time stamp.
+    # The rendering (serialization and layout) follows on the writer thread (with async_output), on peek.flush(), reset()
+    # and at exit, or offline with python -m peek <record file>.
+
+    records = collections.deque()
+
+    @staticmethod
+    def capture(peek, kwargs, this, pairs):
+        stamp = (time.time(), _Peek.perf_counter(), threading.current_thread().name, os.getpid(), this.delta if this.show_delta else None)
+        snapshots = [(pair.label, this.capture(pair.right)) for pair in pairs]
+        record = (stamp, snapshots, this.traceback() if this.show_traceback else "")
+        if this.deferred is True:
+            if this.async_output:
+                _AsyncWriter.put((_Deferred.render, this, *record), this.queue_size, this.overflow)
+            else:
+                _Deferred.records.append((this, *record))
+                if len(_Deferred.records) >= this.queue_size:
+                    _Deferred.render_all()
+        else:
+            _RecordFile.get(this.deferred).write(peek, kwargs, this, record)
+
+    @staticmethod
+    def restore(snapshot):
+        if not isinstance(snapshot, str):
+            return snapshot
+        try:
+            return ast.literal_eval(snapshot)  # so the value can be rendered as usual (e.g. with pprint)
+        except Exception:
+            return _Snapshot(snapshot)
+
+    @staticmethod
+    def render(this, stamp, snapshots, traceback):
+        time_stamp, perf_counter, thread, pid, delta = stamp
+        now = datetime.datetime.fromtimestamp(time_stamp)
+        pairs = []
+        for label, snapshot in snapshots:
+            right = _Deferred.restore(snapshot)
+            pairs.append(types.SimpleNamespace(label=label, left=f"{label}{this.equals_separator}" if label else "", right=right, serialized=_Serialized(this, right)))
+        if this.json_lines:
+            out = this.json_record(
+                timestamp=now.isoformat(),
+                perf_counter=perf_counter,
+                pid=pid,
+                thread=thread,
+                values=[[pair.label, pair.serialized(10000)] for pair in pairs],
+            )
+        else:
+            out = this.layout(pairs, this.context(now=now, delta=delta)) + traceback
+        this.do_output(out)
+
+    @staticmethod
+    def render_all():
+        while True:
+            try:
+                record = _Deferred.records.popleft()
+            except IndexError:
+                return
+            _Deferred.render(*record)
+
+    @staticmethod
+    def decode(path, output="stdout"):
+        # renders the records in a record file to output.
+        # A record file contains only data (no code), so it's safe to decode a file from another user or machine.
+        sites = {}
+        for entry in _RecordFile.entries(path):
+            if entry[0] == "peek":  # the start of the records of a process
+                sites = {}
+            elif entry[0] == "site":
+                _, site_id, recorded_attributes, line_number_with_filename_and_parent, call_site = entry
+                attributes = {}
+                for name, value in recorded_attributes.items():
+                    if name in _Peek.name_default and name not in _RecordFile.not_recorded:
+                        try:
+                            _Peek.check_validity(name, value)
+                            attributes[name] = value
+                        except AttributeError:
+                            pass  # so use the default
+                this = _Peek(**(_Peek.name_default | attributes | dict(output=output)))
+                this._line_number_with_filename_and_parent = line_number_with_filename_and_parent
+                this._call_site = types.SimpleNamespace(**call_site)
+                sites[site_id] = this
+            else:
+                _, site_id, stamp, snapshots, traceback = entry
+                _Deferred.render(sites[site_id], stamp, snapshots, traceback)
+        _FileSink.flush_all()
+
+
+class _RecordFile:
+    # a binary file with deferred records, as a stream of JSON arrays, each preceded by its length (4 bytes, little endian):
+    # a header per process, an entry with the attributes of each call site (and instance) and then the records.
+    # Only plain data is written (attributes like serialize, that are functions, are not recorded), so decoding a
+    # record file never runs any code.
+
+    files = {}
+    lock = threading.Lock()
+    not_recorded = ("output", "deferred", "async_output", "enabled", "filter", "delta", "serialize", "capture")
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        self.site_ids = {}
+        self.dump(["peek", __version__, os.getpid()])
+
+    def dump(self, entry):
+        data = json.dumps(entry, default=repr).encode("utf-8")
+        self.file.write(len(data).to_bytes(4, "little") + data)
+
+    @staticmethod
+    def entries(path):
+        # yields the entries of a record file (an incomplete last entry, e.g. of a crashed process, is ignored)
+        with open(path, "rb") as f:
+            while True:
+                length = f.read(4)
+                if len(length) < 4:
+                    return
+                data = f.read(int.from_bytes(length, "little"))
+                try:
+                    yield json.loads(data.decode("utf-8"))
+                except ValueError:
+                    return
+
+    @staticmethod
+    def is_plain(value):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return True
+        if isinstance(value, (list, tuple)):
+            return all(isinstance(item, str) for item in value)  # e.g. format
+        return False
+
+    @staticmethod
+    def get(path):
+        key = os.path.abspath(path)
+        record_file = _RecordFile.files.get(key)
+        if record_file is None:
+            with _RecordFile.lock:
+                if key not in _RecordFile.files:
+                    _RecordFile.files[key] = _RecordFile(path)
+                record_file = _RecordFile.files[key]
+        return record_file
+
+    def write(self, peek, kwargs, this, record):
+        call_site = this._call_site
+        try:
+            key = (call_site.filename, call_site.line_number, peek, _Peek._generation, tuple(kwargs.items()))
+            hash(key)
+        except TypeError:
+            key = None  # unhashable keyword arguments, so a new site entry for every record
+        with _RecordFile.lock:
+            site_id = self.site_ids.get(key)
+            if site_id is None:
+                site_id = len(self.site_ids)
+                if key is not None:
+                    self.site_ids[key] = site_id
+                else:
+                    self.site_ids[("unhashable", site_id)] = site_id
+                recorded_attributes = {}
+                for name in _Peek.name_default:
+                    if name not in _RecordFile.not_recorded:
+                        value = getattr(this, name)
+                        if _RecordFile.is_plain(value):
+                            recorded_attributes[name] = value
+                call_site = dict(filename=call_site.filename, line_number=call_site.line_number, qualname=call_site.qualname)
+                self.dump(["site", site_id, recorded_attributes, this._line_number_with_filename_and_parent, call_site])
+            self.dump(["record", site_id, *record])
+
+    @staticmethod
+    def flush_all():
+        with _RecordFile.lock:
+            for record_file in _RecordFile.files.values():
+                record_file.file.flush()
+
+    @staticmethod
+    def close_all():
+        with _RecordFile.lock:
+            for record_file in _RecordFile.files.values():
+                record_file.file.close()
+            _RecordFile.files.clear()
+
+
 class _Timer:
     def __init__(self, parent=None):
         self.parent = parent
@@ -830,22 +2419,366 @@ class _Timer:
             return lambda x: x
 
     def __enter__(self):
-        if not self.parent.do_show():
+        # the attributes are read from the resolved attributes (once), as that's much cheaper than via __getattr__
+        # The mode ("aggregate", "tree" or "lines") is determined here, so __exit__ is consistent with __enter__,
+        # even if an attribute is changed within the block.
+        parent = self.parent
+        resolved = parent.resolved_attributes()
+        self._mode = None
+        if resolved["aggregate"] or resolved["tree"]:
+            if parent.do_show():
+                if resolved["aggregate"]:
+                    self._mode = "aggregate"
+                else:
+                    self._mode = "tree"
+                    _TimerTree.enter(parent._line_number_with_filename_and_parent)
+                self._enter_time = _Peek.perf_counter()
+            return self
+        if not (parent.do_show() and parent.output_wanted()):
             return self
-        self._save_traceback = self.parent.traceback()
+        self._mode = "lines"
+        self._threshold = resolved["threshold"]
+        if self._threshold:
+            # the enter line is suppressed and the traceback is only rendered if the threshold is exceeded
+            self._save_stack = _Peek.capture_stack() if resolved["show_traceback"] else None
+        else:
+            self._save_traceback = parent.traceback()
+        if resolved["show_enter"] and not self._threshold:
+            if resolved["json_lines"]:
+                parent.do_output(parent.json_record(event="enter"))
+            else:
+                parent.do_output(f"{parent.context()}enter{self._save_traceback}")
+        self._usage = _Usage.start(parent) if resolved["show_exit"] else None
         self._enter_time = _Peek.perf_counter()
-        if self.parent.show_enter:
-            context = self.parent.context()
-            self.parent.do_output(f"{context}enter{self._save_traceback}")
         return self
 
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *args):
+        return self.__exit__(*args)
+
     def __exit__(self, *args):
-        if not self.parent.do_show():
-            return self
-        if self.parent.show_exit:
-            context = self.parent.context()
-            duration = _Peek.perf_counter() - self._enter_time
-            self.parent.do_output(f"{context}exit in {duration:.6f} seconds{self._save_traceback}")
+        if self._mode is None:
+            return
+        duration = _Peek.perf_counter() - self._enter_time
+        parent = self.parent
+        if self._mode == "aggregate":
+            _TimerStats.add(parent._call_site.key, parent._line_number_with_filename_and_parent, duration, parent, parent._call_site)
+            return
+        if self._mode == "tree":
+            _TimerTree.exit(parent, duration)
+            return
+        resolved = parent.resolved_attributes()
+        if self._usage is not None:
+            self._usage.stop()
+        if not (parent.do_show() and parent.output_wanted()):
+            return
+        if resolved["show_exit"] and (not self._threshold or duration > self._threshold):
+            if resolved["json_lines"]:
+                parent.do_output(parent.json_record(event="exit", duration=duration, **_Usage.fields(self._usage)))
+            else:
+                if self._threshold:
+                    self._save_traceback = parent.traceback(self._save_stack)
+                parent.do_output(f"{parent.context()}exit in {duration:.6f} seconds{_Usage.text(self._usage, parent)}{self._save_traceback}")
+
+
+class _Serialized:
+    # the serializations of one value at several widths, as required for the layout.
+    # Every width is serialized at most once, and not at all if the result can be derived from an earlier serialization.
+
+    container_reprs = (dict.__repr__, list.__repr__, tuple.__repr__, set.__repr__, frozenset.__repr__)
+
+    def __init__(self, peek, obj):
+        self.peek = peek
+        self.obj = obj
+        self.by_width = {}
+        self.fits = None  # (valid_from, serialized) of a serialization that is valid for any width >= valid_from
+
+    def __call__(self, width):
+        if width in self.by_width:
+            return self.by_width[width]
+        if self.fits is not None and self.fits[0] <= width:
+            return self.fits[1]
+        serialized, valid_from = self.peek.serialize_at(self.obj, width)
+        self.by_width[width] = serialized
+        if valid_from is not None:
+            self.fits = (valid_from, serialized)
+        return serialized
+
+    def is_multiline(self, width):
+        if width not in self.by_width and self.fits is not None and self.fits[0] > width:
+            if (
+                self.peek.serialize is pprint.pformat
+                and not self.peek.format
+                and not self.peek.compact
+                and type(self.obj).__repr__ in _Serialized.container_reprs
+                and len(self.obj) >= 2
+            ):
+                # pprint puts each item of a container on a separate line if the representation doesn't fit
+                return True
+        return lf in self(width)
+
+
+class _LimitedRepr(reprlib.Repr):
+    # reprlib.Repr sorts the items of dicts and sets, so the first items shown wouldn't be the first items of the
+    # container (and sorting a big container isn't cheap). Here, the items are taken in iteration order, like repr does.
+
+    def repr_dict(self, x, level):
+        if not x:
+            return "{}"
+        if level <= 0:
+            return "{...}"
+        pieces = [f"{self.repr1(key, level - 1)}: {self.repr1(value, level - 1)}" for key, value in itertools.islice(x.items(), self.maxdict)]
+        if len(x) > self.maxdict:
+            pieces.append("...")
+        return f"{{{', '.join(pieces)}}}"
+
+    def repr_set(self, x, level):
+        if not x:
+            return "set()"
+        return self._repr_iterable(x, level, "{", "}", self.maxset)
+
+    def repr_frozenset(self, x, level):
+        if not x:
+            return "frozenset()"
+        return self._repr_iterable(x, level, "frozenset({", "})", self.maxfrozenset)
+
+
+class _TimedAwaitable:
+    # drives an awaitable step by step, so the time that it's actually running (so excluding the time
+    # it's suspended, waiting for the event loop) can be measured
+
+    def __init__(self, awaitable):
+        self.awaitable = awaitable
+        self.running = 0
+
+    def __await__(self):
+        iterator = self.awaitable.__await__() if hasattr(self.awaitable, "__await__") else self.awaitable
+        value = None
+        exception = None
+        while True:
+            start = _Peek.perf_counter()
+            try:
+                if exception is None:
+                    to_yield = iterator.send(value)
+                else:
+                    to_yield = iterator.throw(exception)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.running += _Peek.perf_counter() - start
+            try:
+                value = yield to_yield
+                exception = None
+            except GeneratorExit:
+                iterator.close()
+                raise
+            except BaseException as e:
+                value = None
+                exception = e
+
+
+class _AsyncGeneratorProxy:
+    # iterates over an async generator, passing any value sent (via sent) or exception thrown (via thrown),
+    # and records the wall time and the running time of the last step
+
+    def __init__(self, async_generator):
+        self.async_generator = async_generator
+        self.sent = None
+        self.thrown = None
+        self.duration = 0
+        self.running = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.thrown is None:
+            step = self.async_generator.asend(self.sent)
+        else:
+            step = self.async_generator.athrow(self.thrown)
+        timed = _TimedAwaitable(step)
+        self.sent = None
+        self.thrown = None
+        start = _Peek.perf_counter()
+        try:
+            return await timed
+        finally:
+            self.duration = _Peek.perf_counter() - start
+            self.running = timed.running
+
+
+class _NullTimer:
+    # returned by a disabled timer: a transparent decorator and a context manager that does nothing
+    def __call__(self, function):
+        return function
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class _Usage:
+    # the resources used by a timed function or with block, besides the wall time.
+    # With show_memory, tracemalloc is started by the first active measurement and stopped by the last one (unless
+    # tracemalloc was already tracing). As resetting the peak affects all measurements, the peak so far is passed to
+    # every active measurement before a reset.
+    # With show_gc, a callback is added to gc.callbacks by the first active measurement and removed by the last one.
+    # That callback counts the collections and accumulates the time spent in them.
+
+    lock = threading.Lock()
+    active = []  # the measurements with show_memory
+    started_tracing = False
+    gc_users = 0
+    gc_start = None
+    gc_collections = 0
+    gc_time = 0
+
+    def __init__(self, show_memory, show_cpu, show_gc):
+        self.top = 0 if show_memory is True else show_memory  # number of source lines with the largest allocations to show
+        self.show_memory = bool(show_memory)
+        self.show_cpu = show_cpu
+        self.show_gc = show_gc
+        self.peak = 0
+        self.snapshot = None
+        self.net = 0
+        self.blocks = 0
+        self.top_lines = []
+
+    @staticmethod
+    def start(this):
+        # returns None if there's nothing to measure, so the overhead is minimal
+        resolved = this.resolved_attributes()
+        if not (resolved["show_memory"] or resolved["show_cpu"] or resolved["show_gc"]):
+            return None
+        usage = _Usage(resolved["show_memory"], resolved["show_cpu"], resolved["show_gc"])
+        with _Usage.lock:
+            if usage.show_gc:
+                if _Usage.gc_users == 0:
+                    gc.callbacks.append(_Usage.gc_callback)
+                _Usage.gc_users += 1
+                usage.start_gc = (_Usage.gc_collections, _Usage.gc_time)
+            if usage.show_memory:
+                if not _Usage.active and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _Usage.started_tracing = True
+                _Usage.pass_peak()
+                _Usage.active.append(usage)
+                if usage.top:
+                    usage.snapshot = tracemalloc.take_snapshot()
+                usage.start_blocks = sys.getallocatedblocks()
+                usage.start_memory = usage.peak = tracemalloc.get_traced_memory()[0]
+        if usage.show_cpu:
+            usage.start_cpu = (time.process_time(), time.thread_time(), _Usage.context_switches())
+        return usage
+
+    @staticmethod
+    def gc_callback(phase, info):
+        if phase == "start":
+            _Usage.gc_start = time.perf_counter()
+        elif _Usage.gc_start is not None:
+            _Usage.gc_collections += 1
+            _Usage.gc_time += time.perf_counter() - _Usage.gc_start
+            _Usage.gc_start = None
+
+    @staticmethod
+    def context_switches():
+        # the number of voluntary and involuntary context switches of the process (not available on Windows)
+        if resource is None:
+            return (0, 0)
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        return (rusage.ru_nvcsw, rusage.ru_nivcsw)
+
+    @staticmethod
+    def pass_peak():
+        peak = tracemalloc.get_traced_memory()[1]
+        for usage in _Usage.active:
+            usage.peak = max(usage.peak, peak)
+        tracemalloc.reset_peak()
+
+    def stop(self):
+        if self.show_cpu:
+            voluntary, involuntary = _Usage.context_switches()
+            self.process_time = time.process_time() - self.start_cpu[0]
+            self.thread_time = time.thread_time() - self.start_cpu[1]
+            self.voluntary = voluntary - self.start_cpu[2][0]
+            self.involuntary = involuntary - self.start_cpu[2][1]
+        with _Usage.lock:
+            if self.show_memory:
+                self.blocks = sys.getallocatedblocks() - self.start_blocks
+                self.net = tracemalloc.get_traced_memory()[0] - self.start_memory
+                if self.snapshot is not None:
+                    # the allocations by peek itself (and executing, as used by peek) are not of interest
+                    filters = (
+                        tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, __file__),
+                        tracemalloc.Filter(False, os.path.join(os.path.dirname(executing.__file__), "*")),
+                    )
+                    differences = tracemalloc.take_snapshot().filter_traces(filters).compare_to(self.snapshot.filter_traces(filters), "lineno")
+                    self.top_lines = [
+                        (f"{Path(difference.traceback[0].filename).name}:{difference.traceback[0].lineno}", difference.size_diff, difference.count_diff)
+                        for difference in differences[: self.top]
+                    ]
+                    self.snapshot = None
+                _Usage.pass_peak()
+                self.peak -= self.start_memory
+                _Usage.active.remove(self)
+                if not _Usage.active and _Usage.started_tracing:
+                    tracemalloc.stop()
+                    _Usage.started_tracing = False
+            if self.show_gc:
+                self.gc_collections = _Usage.gc_collections - self.start_gc[0]
+                self.gc_time = _Usage.gc_time - self.start_gc[1]
+                _Usage.gc_users -= 1
+                if _Usage.gc_users == 0:
+                    gc.callbacks.remove(_Usage.gc_callback)
+
+    @staticmethod
+    def text(usage, this):
+        if usage is None:
+            return ""
+        text = ""
+        if usage.show_cpu:
+            text += (
+                f" (cpu: process {usage.process_time:.6f} seconds, thread {usage.thread_time:.6f} seconds,"
+                f" context switches {usage.voluntary:,} voluntary, {usage.involuntary:,} involuntary)"
+            )
+        if usage.show_gc:
+            text += f" (gc: {usage.gc_collections:,} collections in {usage.gc_time:.6f} seconds)"
+        if usage.show_memory:
+            text += f" (memory: net {usage.net:+,} bytes, peak {usage.peak:,} bytes, {usage.blocks:+,} blocks)"
+            for location, size, count in usage.top_lines:
+                text += f"{lf}{this.prefix}    {location}: {size:+,} bytes ({count:+,} blocks)"
+        return text
+
+    @staticmethod
+    def fields(usage):
+        if usage is None:
+            return {}
+        fields = {}
+        if usage.show_cpu:
+            fields |= dict(
+                process_time=usage.process_time,
+                thread_time=usage.thread_time,
+                voluntary_context_switches=usage.voluntary,
+                involuntary_context_switches=usage.involuntary,
+            )
+        if usage.show_gc:
+            fields |= dict(gc_collections=usage.gc_collections, gc_time=usage.gc_time)
+        if usage.show_memory:
+            fields |= dict(memory_net=usage.net, memory_peak=usage.peak, memory_blocks=usage.blocks)
+            if usage.top:
+                fields["memory_top"] = usage.top_lines
+        return fields
 
 
 class _PeekModule(types.ModuleType):
@@ -866,6 +2799,13 @@ class _PeekModule(types.ModuleType):
 
 
 reset()
+atexit.register(_FileSink.close_all)
+atexit.register(_RecordFile.close_all)
+atexit.register(_AsyncWriter.drain)  # atexit calls in reverse order, so this drains before the files are closed
+atexit.register(_Deferred.render_all)  # and the pending deferred records are rendered before that
+atexit.register(_Throttle.report)
+atexit.register(_Repeats.report_all)
+atexit.register(_TimerStats.report_at_exit)
 
 if __name__ != "__main__":
     sys.modules["peek"].__class__ = _PeekModule
@@ -4,6 +4,7 @@ import time
 import pytest
 import os
 import shutil
+import math
 from pathlib import Path
 
 
@@ -55,6 +56,46 @@ def test_time(patch_datetime_now):
     assert s == "@ 00:00:00.000000 ==> hello='world'\n"
 
 
+def test_call_site_cache(capsys):
+    for i in range(3):
+        peek(i, show_line_number=True)
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert len(lines) == 3
+    assert all(line.endswith(f" in test_call_site_cache() ==> i={i}") for i, line in enumerate(lines))
+    assert len({line.split(" ")[0] for line in lines}) == 1
+    assert len([call_site for call_site in type(peek)._call_sites.values() if call_site.code is test_call_site_cache.__code__]) == 1
+
+    saved = type(peek)._call_sites_max
+    type(peek)._call_sites_max = len(type(peek)._call_sites) + 2
+    try:
+        for i in range(10):
+            exec(compile("peek(i)", f"<generated {i}>", "exec"))  # every compiled code object is a new call site
+        assert len(type(peek)._call_sites) == type(peek)._call_sites_max
+    finally:
+        type(peek)._call_sites_max = saved
+    capsys.readouterr()
+
+    # the per call site state of every, dedupe and aggregating with blocks is bounded in the same way
+    module = sys.modules[type(peek).__module__]
+    module._Throttle.throttles.clear()
+    module._Repeats.sites.clear()
+    module._TimerStats.stats.clear()
+    type(peek)._call_sites_max = 3
+    try:
+        for i in range(10):
+            source = "for j in range(2):\n    peek(i, every=2)\n    peek(i, dedupe=True)\n    with peek.timer(aggregate=True):\n        pass"
+            exec(compile(source, f"<generated {i}>", "exec"))
+        assert len(module._Throttle.throttles) == len(module._Repeats.sites) == len(module._TimerStats.stats) == 3
+        assert all(stats.call_site is not None for stats in module._TimerStats.stats.values())
+    finally:
+        type(peek)._call_sites_max = saved
+        out = capsys.readouterr().out
+        peek.reset()
+    assert out.count("suppressed 1 of 2 calls") == 7  # the evicted call sites
+    assert out.count("... repeated 1 times") == 7
+
+
 def test_no_arguments(capsys):
     result = peek()
     out, err = capsys.readouterr()
@@ -188,6 +229,24 @@ def test_calls():
         peek(a=1)
 
 
+def test_validated_spec_cache():
+    _Peek = type(peek)
+    spec0 = _Peek.spec_to_attributes(color="red", ll=120)
+    spec1 = _Peek.spec_to_attributes(color="red", ll=120)
+    assert spec0 == spec1 == {"color": "red", "line_length": 120}
+    assert spec0 is not spec1
+    assert _Peek.spec_to_attributes(color=1) == {"color": "white"}
+    for _ in range(2):
+        with pytest.raises(AttributeError):
+            _Peek.spec_to_attributes(color=9)
+    assert _Peek.spec_to_attributes(format=["5d"]) == {"format": ["5d"]}  # unhashable
+    peek.fix_perf_counter(10)
+    assert _Peek.spec_to_attributes(delta=1)["delta1"] == 10
+    peek.fix_perf_counter(20)
+    assert _Peek.spec_to_attributes(delta=1)["delta1"] == 20
+    peek.fix_perf_counter(None)
+
+
 def test_repr_and_str(capsys):
     print(str(peek))
     out, err = capsys.readouterr()
@@ -276,6 +335,200 @@ def test_output(capsys, tmpdir):
         assert out == "hello='world' [len=5]\n"
 
 
+def test_file_sink(tmpdir):
+    path = Path(tmpdir) / "sink"
+    with peek.preserve():
+        peek.configure(output=path, flush_interval=1000)
+        for i in range(3):
+            peek(i)
+        assert path.read_text() == ""
+        peek.flush()
+        assert path.read_text() == "i=0\ni=1\ni=2\n"
+        peek(3)
+        peek.output = "stdout"  # reconfiguring output flushes
+        assert path.read_text() == "i=0\ni=1\ni=2\n3\n"
+    with pytest.raises(AttributeError):
+        peek(1, buffer_size=0)
+    with pytest.raises(AttributeError):
+        peek(1, flush_interval=-1)
+
+    # the last records of a burst are flushed by a timer when the interval has passed, without any further writes
+    _FileSink = sys.modules[type(peek).__module__]._FileSink
+    with peek.preserve():
+        peek.configure(output=path, flush_interval=1000)
+        peek(4)
+        peek(5)
+        sink = _FileSink.sinks[str(path)]
+        assert sink.flush_timer is not None
+        assert not path.read_text().endswith("\n5\n")
+        sink.flush_by_timer()
+        assert sink.flush_timer is None
+        assert path.read_text().endswith("\n4\n5\n")
+
+    # alternating buffer sizes don't reopen the file
+    assert _FileSink.get(path, 100) is _FileSink.get(path, 200) is sink
+
+    # a relative path is resolved on every write, so it follows a change of the working directory
+    cwd = os.getcwd()
+    for directory in ("a", "b"):
+        (Path(tmpdir) / directory).mkdir()
+        os.chdir(Path(tmpdir) / directory)
+        try:
+            peek(directory, output="relative.txt")
+        finally:
+            os.chdir(cwd)
+    peek.flush()
+    assert (Path(tmpdir) / "a" / "relative.txt").read_text() == "directory='a'\n"
+    assert (Path(tmpdir) / "b" / "relative.txt").read_text() == "directory='b'\n"
+
+
+def test_async_output():
+    import threading
+
+    _AsyncWriter = sys.modules[type(peek).__module__]._AsyncWriter
+    result = []
+    release = threading.Event()
+
+    def output(s):
+        release.wait(10)
+        result.append(s)
+
+    release.set()
+    with peek.preserve():
+        peek.configure(async_output=True, output=output)
+        for i in range(100):
+            peek(i)
+        peek.flush()
+        assert result == [f"i={i}\n" for i in range(100)]
+
+        result.clear()
+        release.clear()
+        dropped = peek.dropped_records()
+        peek.configure(queue_size=1, overflow="drop_newest")
+        peek(0)
+        t0 = time.perf_counter()
+        while not _AsyncWriter.busy and time.perf_counter() - t0 < 10:  # wait till the writer is blocked in output
+            time.sleep(0.001)
+        peek(1)
+        peek(2)
+        peek.overflow = "drop_oldest"
+        peek(3)
+        release.set()
+        peek.flush()
+        assert result == ["0\n", "3\n"]
+        assert peek.dropped_records()["drop_newest"] == dropped["drop_newest"] + 1
+        assert peek.dropped_records()["drop_oldest"] == dropped["drop_oldest"] + 1
+    with pytest.raises(AttributeError):
+        peek(1, overflow="drop")
+
+
+def test_logging_level(caplog):
+    import logging
+
+    serialized = []
+
+    def serialize(obj):
+        serialized.append(obj)
+        return repr(obj)
+
+    logger = logging.getLogger("peek_test")
+    logger.setLevel(logging.INFO)
+    x = 1
+    with caplog.at_level(logging.INFO, logger="peek_test"):
+        peek(x, output=logger.debug, serialize=serialize)
+        peek(x, output="logging.debug:peek_test", serialize=serialize)
+        with peek.timer(output=logger.debug):
+            pass
+        assert serialized == []
+        assert caplog.records == []
+
+        to_debug = peek.new(output="logging.debug:peek_test", serialize=serialize)
+        assert to_debug(x) == 1
+        assert to_debug(x, 2) == (1, 2)
+        assert to_debug.timer(lambda: 3)() == 3
+        assert serialized == []
+        assert to_debug(x, as_str=True) == "x=1\n"
+        assert to_debug(x, output="stdout", as_str=True) == "x=1\n"
+        assert caplog.records == []
+
+        peek(x, output=logger.info)
+        peek(x, output="logging.warning:peek_test")
+    assert [(record.name, record.levelname, record.getMessage()) for record in caplog.records] == [
+        ("peek_test", "INFO", "x=1"),
+        ("peek_test", "WARNING", "x=1"),
+    ]
+
+
+def test_json_lines(capsys):
+    import json
+
+    hello = "world"
+    peek(hello, 12, json_lines=True)
+    with peek.timer(jl=True):
+        pass
+    lines = capsys.readouterr().out.splitlines()
+    record = json.loads(lines[0])
+    assert record["values"] == [["hello", "'world'"], ["", "12"]]
+    assert record["qualname"] == "test_json_lines"
+    assert record["line"] == sys._getframe().f_lineno - 7
+    assert {"timestamp", "perf_counter", "pid", "thread", "file", "level"} <= record.keys()
+    assert [json.loads(line)["event"] for line in lines[1:]] == ["enter", "exit"]
+    assert json.loads(lines[2])["duration"] >= 0
+
+
+def test_deferred(capsys, tmp_path):
+    import subprocess
+
+    class Thing:
+        def __repr__(self):
+            return "Thing()"
+
+    d = dict(a=list(range(30)), b="b")
+    thing = Thing()
+    peek(d, thing)
+    expected = capsys.readouterr().out
+    peek(d, thing, deferred=True)
+    assert capsys.readouterr().out == ""
+    peek.flush()
+    assert capsys.readouterr().out == expected
+
+    path = tmp_path / "peek.records"
+    peek(d, thing, deferred=path)
+    peek(d, thing, deferred=path, capture=lambda obj: "captured")
+    peek.flush()
+    assert capsys.readouterr().out == ""
+    result = subprocess.run([sys.executable, "-m", "peek", str(path)], capture_output=True, text=True, cwd=Path(__file__).parent.parent)
+    assert result.stdout == expected + "d=captured, thing=captured\n"
+
+    # the record file contains only data, so attributes that are functions are not recorded
+    peek(d, deferred=path, serialize=lambda obj: "serialized", line_length=120)
+    peek.flush()
+    *_, site, record = sys.modules[type(peek).__module__]._RecordFile.entries(path)
+    assert site[0] == "site" and "serialize" not in site[2] and site[2]["line_length"] == 120
+    assert record[0] == "record" and record[3] == [["d", repr(d)]]
+    assert path.read_bytes()[4:12] == b'["peek",'
+
+
+def test_accepted_parameters(capsys):
+    _Peek = type(peek)
+
+    def serialize(obj, width=80):
+        return f"{obj!r}/{width}"
+
+    class Output:
+        def write(self, s, end=""):
+            print(s, end=end)
+
+    assert _Peek.accepted_parameters(serialize) == {"obj", "width"}
+    assert serialize in _Peek._accepted_parameters
+    assert "end" in _Peek.accepted_parameters(Output().write)
+    assert Output.write in _Peek._accepted_parameters
+    assert "end" in _Peek.accepted_parameters(print)
+    peek(1, serialize=serialize, output=Output().write)
+    out, err = capsys.readouterr()
+    assert out == "1/10000\n"
+
+
 def test_show_time(capsys):
     hello = "world"
     peek(hello, show_time=True)
@@ -292,6 +545,16 @@ def test_show_delta(capsys):
     assert "delta=" in out
 
 
+def test_to_clipboard(capsys, monkeypatch):
+    copied = []
+    monkeypatch.setattr(type(peek), "copy_to_clipboard", lambda self, value, confirm=True: copied.append(value))
+    hello = "world"
+    peek(hello, to_clipboard=True)
+    peek(to_clipboard=True)  # without arguments, an empty string is copied
+    assert copied == ["world", ""]
+    capsys.readouterr()
+
+
 def test_as_str():
     hello = "world"
     s = peek(hello, as_str=True, color="red")
@@ -543,6 +806,18 @@ def test_color_alias():
         assert peek.color_value == peek.col_val == peek.cv == "green"
 
 
+def test_compiled_filter(capsys):
+    compiled_filter = type(peek).compile_filter("level >= 2 and all(x < lvl + 10 for x in (level,))")
+    assert compiled_filter[1] == ("level", "lvl")
+    assert type(peek).compile_filter(" ") is None
+    with peek.preserve():
+        peek.filter = "all(x >= 2 for x in (level,))"
+        for i in range(4):
+            peek(i, level=i)
+    out, err = capsys.readouterr()
+    assert out == "i=2\ni=3\n"
+
+
 def test_incorrect_filter():
     with pytest.raises(AttributeError):
         peek.filter = "color='blue'"
@@ -551,6 +826,72 @@ def test_incorrect_filter():
         peek.filter = "colour=='blue'"
 
 
+def test_sampling_and_rate_limiting(capsys):
+    _Throttle = sys.modules[type(peek).__module__]._Throttle
+    serialized = []
+
+    def serialize(obj):
+        serialized.append(obj)
+        return repr(obj)
+
+    for i in range(10):
+        peek(i, every=4, serialize=serialize)
+    assert serialized == [0, 4, 8]
+    assert capsys.readouterr().out == "i=0\ni=4\ni=8\n"
+
+    for i in range(10):
+        peek(i, sample=0)
+        peek(i, sample=0.5, sample_key="user 1")  # the same decision every time
+    assert capsys.readouterr().out.splitlines() == [f"i={i}" for i in range(10)]
+
+    peek.fix_perf_counter(100)
+    for i in range(10):
+        peek(i, max_per_second=3)
+    peek.fix_perf_counter(101)
+    peek(10, max_per_second=3)
+    peek.fix_perf_counter(None)
+    assert capsys.readouterr().out == "i=0\ni=1\ni=2\n10\n"
+
+    assert sorted(peek.suppressed_records().values()) == [0, 0, 7, 7, 10]
+
+    for i in range(4):
+        peek(i, every=2); peek(-i, every=2)  # two call sites on one line, each with its own counter
+    assert capsys.readouterr().out == "i=0\n-i=0\ni=2\n-i=-2\n"
+    exec("for i in range(4): peek(i, every=2)")
+    assert capsys.readouterr().out == "0\n2\n"  # no source available, so no labels
+    _Throttle.report()
+    out = capsys.readouterr().out
+    assert "suppressed 7 of 10 calls" in out
+    assert out.count("suppressed 2 of 4 calls") == 3
+    assert "<string> ==> suppressed 2 of 4 calls" in out  # exec'ed code has no line number
+    peek.reset()
+    assert peek.suppressed_records() == {}
+
+
+def test_dedupe(capsys):
+    peek.fix_perf_counter(0)
+    for i in range(10):
+        peek.fix_perf_counter(i * 0.5)
+        x = i // 4
+        peek(x, dedupe=True)
+    peek.flush()
+    peek.fix_perf_counter(None)
+    assert capsys.readouterr().out == (
+        "x=0\n"
+        "... repeated 3 times over 1.5s\n"
+        "x=1\n"
+        "... repeated 3 times over 1.5s\n"
+        "x=2\n"
+        "... repeated 1 times over 0.5s\n"
+    )
+
+    for i in range(3):
+        a, b = 1, 2
+        peek(a, dedupe=True); peek(b, dedupe=True)  # two call sites on one line, each with its own last record
+    peek.flush()
+    assert capsys.readouterr().out == "a=1\nb=2\n... repeated 2 times over 0.0s\n... repeated 2 times over 0.0s\n"
+
+
 def test_as_timer_decorator(capsys):
     peek.fix_perf_counter(0)
 
@@ -749,6 +1090,468 @@ exit in 0.000000 seconds
     peek.fix_perf_counter(None)
 
 
+def test_aggregate(capsys):
+    _TimerStats = sys.modules[type(peek).__module__]._TimerStats
+
+    @peek.timer(aggregate=True)
+    def square(x):
+        return x * x
+
+    assert [square(i) for i in range(100)] == [i * i for i in range(100)]
+    with peek.timer(agg=True):
+        pass
+    assert capsys.readouterr().out == ""
+    assert sorted((stats.label, stats.count) for stats in _TimerStats.stats.values()) == [
+        (f"#{sys._getframe().f_lineno - 4}[test_peek.py] in test_aggregate()", 1),
+        ("test_aggregate.square()", 100),
+    ]
+
+    for i in range(1, 1001):
+        _TimerStats.add("test", "test", i * 0.000001, peek)
+    stats = _TimerStats.stats["test"]
+    assert stats.count == 1000
+    assert stats.minimum == pytest.approx(0.000001)
+    assert stats.maximum == pytest.approx(0.001)
+    assert stats.mean == pytest.approx(0.0005005)
+    assert stats.stddev() == pytest.approx(0.000288819, rel=1e-4)
+    for fraction in (0.5, 0.9, 0.99):
+        assert stats.percentile(fraction) == pytest.approx(fraction * 0.001, rel=0.05)
+
+    lines = peek.timer_report(as_str=True).splitlines()
+    assert lines[0].split() == ["timer", "count", "total(s)", "mean(us)", "stddev(us)", "min(us)", "p50(us)", "p90(us)", "p99(us)", "max(us)"]
+    assert lines[3].split()[:5] == ["test", "1000", "0.500500", "500.500", "288.819"]
+    # at exit, the report is only output again if anything was collected since the last report
+    capsys.readouterr()
+    _TimerStats.report_at_exit()
+    assert capsys.readouterr().out == ""
+    _TimerStats.add("test", "test", 0.000001, peek)
+    _TimerStats.report_at_exit()
+    assert "1001" in capsys.readouterr().out
+    peek.reset()
+    assert peek.timer_report(as_str=True) == ""
+
+
+def test_timer_mode_changed_in_block(capsys):
+    # the mode of a with peek.timer() block is determined on entry, so changing attributes within the block is harmless
+    _TimerStats = sys.modules[type(peek).__module__]._TimerStats
+    with peek.preserve():
+        with peek.timer(show_enter=False):
+            peek.configure(tree=True)
+        assert capsys.readouterr().out.startswith("exit in ")
+    with peek.preserve():
+        p = peek.fork(aggregate=True)
+        with p.timer():
+            p.aggregate = False
+        with p.timer(show_enter=False):
+            p.aggregate = True
+        assert capsys.readouterr().out.startswith("exit in ")
+        assert sum(stats.count for stats in _TimerStats.stats.values()) == 1
+    peek.reset()
+
+
+def test_timer_arguments(capsys):
+    class Counted:
+        reprs = 0
+
+        def __repr__(self):
+            Counted.reprs += 1
+            return "Counted()"
+
+    @peek.timer(show_enter=False, show_exit=False)
+    def f(x):
+        return x
+
+    f(Counted())
+    assert Counted.reprs == 0
+
+    @peek.timer(max_arg_items=3, max_arg_chars=20)
+    def g(x, y=None):
+        return x
+
+    @peek.timer(show_args="len", show_enter=False)
+    def h(x, y):
+        return x
+
+    peek.fix_perf_counter(0)
+    g(list(range(100)), y="peek" * 10)
+    h(list(range(100)), 1)
+    peek.fix_perf_counter(None)
+    assert capsys.readouterr().out == (
+        "called g([0, 1, 2, ...], y='peekpeekpeekpeekpee...)\n"
+        "returned [0, 1, 2, ...] from g([0, 1, 2, ...], y='peekpeekpeekpeekpee...) in 0.000000 seconds\n"
+        "returned list(len=100) from h(list(len=100), int) in 0.000000 seconds\n"
+    )
+
+    @peek.timer(max_arg_items=2, show_enter=False)
+    def k(x):
+        pass
+
+    peek.fix_perf_counter(0)
+    k({"b": 1, "a": 2, "c": {"z": 1, "y": 2, "x": 3}})
+    peek.fix_perf_counter(None)
+    assert capsys.readouterr().out == "returned None from k({'b': 1, 'a': 2, ...}) in 0.000000 seconds\n"
+
+
+def test_timer_tree(capsys):
+    _TimerTree = sys.modules[type(peek).__module__]._TimerTree
+
+    @peek.timer(tree=True)
+    def inner():
+        pass
+
+    @peek.timer(tree=True)
+    def outer():
+        inner()
+        inner()
+
+    peek.fix_perf_counter(0)
+    with peek.timer(tree=True):
+        outer()
+        outer()
+    peek.fix_perf_counter(None)
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[:2] for line in lines[2:]] == [["test_timer_tree.outer()", "2"], ["test_timer_tree.inner()", "4"]]
+    assert lines[1].startswith(f"#{sys._getframe().f_lineno - 6}[test_peek.py] in test_timer_tree() ")
+
+    _TimerTree.enter("a")
+    _TimerTree.enter("b")
+    _TimerTree.exit(peek, 0.25)
+    _TimerTree.enter("b")
+    _TimerTree.exit(peek, 0.25)
+    _TimerTree.exit(peek, 2)
+    assert capsys.readouterr().out == (
+        "timer tree      count  cumulative(s)      self(s)  parent(%)\n"
+        "a                   1       2.000000     1.500000\n"
+        "    b               2       0.500000     0.500000       25.0\n"
+    )
+
+    import asyncio
+
+    async def task(name):
+        async with peek.timer(tree=True, prefix=f"{name}| "):
+            await asyncio.sleep(0)  # so the other task enters its block while this block is active
+
+    async def main():
+        await asyncio.gather(task("a"), task("b"))
+
+    asyncio.run(main())
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 4  # two separate trees (header and one timer each), so task b's block is not a child of task a's
+    assert lines[0].startswith("a| timer tree")
+    assert lines[2].startswith("b| timer tree")
+
+
+def test_async_timer(capsys):
+    import asyncio
+
+    @peek.timer
+    async def double(x):
+        await asyncio.sleep(0)
+        return x * 2
+
+    @peek.timer(show_enter=False)
+    async def count(n):
+        for i in range(n):
+            await asyncio.sleep(0)
+            yield i
+
+    async def main():
+        assert await double(3) == 6
+        assert [i async for i in count(2)] == [0, 1]
+        async with peek.timer():
+            await asyncio.sleep(0)
+
+    peek.fix_perf_counter(0)
+    asyncio.run(main())
+    peek.fix_perf_counter(None)
+    assert capsys.readouterr().out == (
+        "called double(3)\n"
+        "returned 6 from double(3) in 0.000000 seconds (0.000000 seconds running)\n"
+        "yielded 0 from count(2) in 0.000000 seconds (0.000000 seconds running)\n"
+        "yielded 1 from count(2) in 0.000000 seconds (0.000000 seconds running)\n"
+        "exhausted count(2) after 2 items in 0.000000 seconds (0.000000 seconds running)\n"
+        "enter\n"
+        "exit in 0.000000 seconds\n"
+    )
+
+    @peek.timer(json_lines=True)
+    async def wait():
+        time.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(wait())
+    import json
+
+    record = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert 0.01 <= record["running"] < 0.05
+    assert record["duration"] >= 0.1
+
+    @peek.timer(tree=True)
+    async def inner():
+        await asyncio.sleep(0)
+
+    @peek.timer(tree=True)
+    async def outer():
+        await inner()
+        await inner()
+
+    @peek.timer(aggregate=True)
+    async def items(n):
+        for i in range(n):
+            yield i
+
+    async def main():
+        await outer()
+        assert [i async for i in items(3)] == [0, 1, 2]
+
+    _TimerStats = sys.modules[type(peek).__module__]._TimerStats
+    asyncio.run(main())
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[:2] for line in lines[1:]] == [["test_async_timer.outer()", "1"], ["test_async_timer.inner()", "2"]]
+    assert [stats.count for stats in _TimerStats.stats.values() if stats.label == "test_async_timer.items()"] == [1]
+    peek.reset()
+
+    async def recovering():
+        try:
+            yield 1
+        except ValueError:
+            yield 99
+        yield 2
+
+    async def main(decorator):
+        agen = decorator(recovering)()
+        assert await agen.__anext__() == 1
+        assert await agen.athrow(ValueError()) == 99
+        assert await agen.__anext__() == 2
+        await agen.aclose()
+        agen = decorator(recovering)()
+        await agen.__anext__()
+        with pytest.raises(KeyError):
+            await agen.athrow(KeyError())
+
+    asyncio.run(main(peek.timer(output="null")))
+    peek.fix_perf_counter(0)
+    asyncio.run(main(peek.timer(show_enter=False)))
+    peek.fix_perf_counter(None)
+    assert capsys.readouterr().out.splitlines()[-1] == "raised recovering() after 1 items in 0.000000 seconds (0.000000 seconds running)"
+
+
+def test_generator_timer(capsys):
+    @peek.timer(show_enter=False)
+    def numbers(n):
+        for i in range(n):
+            received = yield i
+            if received is not None:
+                yield received
+
+    assert list(numbers(3)) == [0, 1, 2]
+    generator = numbers(3)
+    assert next(generator) == 0
+    assert generator.send("x") == "x"
+    generator.close()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("exhausted numbers(3) after 3 items in ")
+    assert "items per second, per item: mean " in lines[0]
+    assert lines[1].startswith("closed numbers(3) after 2 items in ")
+
+    peek.fix_perf_counter(0)
+    assert list(numbers(1)) == [0]
+    peek.fix_perf_counter(None)
+    assert capsys.readouterr().out == (
+        "exhausted numbers(1) after 1 items in 0.000000 seconds active (first item after 0.000000 seconds, - items per second,"
+        " per item: mean 0.000000, p50 0.000000, p99 0.000000, max 0.000000 seconds)\n"
+    )
+
+    @peek.timer(aggregate=True)
+    def squares(n):
+        for i in range(n):
+            yield i * i
+
+    @peek.timer(tree=True)
+    def pipeline():
+        for _ in range(2):
+            yield from squares_in_tree(2)
+
+    @peek.timer(tree=True)
+    def squares_in_tree(n):
+        yield from range(n)
+
+    _TimerStats = sys.modules[type(peek).__module__]._TimerStats
+    assert list(squares(3)) == [0, 1, 4]
+    assert list(squares(2)) == [0, 1]
+    assert capsys.readouterr().out == ""
+    assert [stats.count for stats in _TimerStats.stats.values() if stats.label == "test_generator_timer.squares()"] == [2]
+    assert "test_generator_timer.squares()" in peek.timer_report(as_str=True)
+
+    assert list(pipeline()) == [0, 1, 0, 1]
+    lines = capsys.readouterr().out.splitlines()
+    # the inner generators are reported separately, as they finish before the outer generator
+    assert [line.split()[:2] for line in lines if not line.startswith("timer tree")] == [
+        ["test_generator_timer.squares_in_tree()", "1"],
+        ["test_generator_timer.squares_in_tree()", "1"],
+        ["test_generator_timer.pipeline()", "1"],
+    ]
+    peek.reset()
+
+
+def test_show_memory(capsys):
+    import json
+    import tracemalloc
+
+    def net_and_peak(line):
+        return [int(part.split()[1].replace(",", "")) for part in line.split("(memory: ")[1].split(", ")[:2]]
+
+    @peek.timer(show_memory=True, show_enter=False)
+    def allocate(n):
+        return bytearray(n)
+
+    with peek.timer(show_memory=2, show_enter=False):
+        keep = [bytes(1000) for _ in range(100)]
+        with peek.timer(show_memory=True, show_enter=False):
+            temporary = bytearray(1_000_000)
+            del temporary
+        allocate(10_000)
+    assert not tracemalloc.is_tracing()  # started by the outer timer and stopped when that exits
+
+    inner, function, outer, *top_lines = capsys.readouterr().out.splitlines()
+    assert inner.startswith("exit in ")
+    assert net_and_peak(inner)[1] >= 990_000
+    assert function.startswith("returned bytearray(") and "(memory: net +" in function
+    assert outer.startswith("exit in ")
+    net, peak = net_and_peak(outer)
+    assert net >= 100_000
+    assert peak >= 990_000  # the peak of the inner timer is included
+    assert len(top_lines) == 2
+    assert top_lines[0].startswith("    test_peek.py:")
+
+    with peek.timer(show_memory=True, json_lines=True, show_enter=False):
+        keep = bytearray(10_000)
+    record = json.loads(capsys.readouterr().out)
+    assert record["memory_net"] >= 10_000
+    assert record["memory_peak"] >= 10_000
+    assert "memory_top" not in record
+
+
+def test_show_cpu_and_gc(capsys):
+    import gc
+    import json
+
+    @peek.timer(show_cpu=True, show_enter=False, json_lines=True)
+    def wait():
+        time.sleep(0.05)
+
+    wait()
+    record = json.loads(capsys.readouterr().out)
+    assert record["process_time"] < record["duration"] / 2  # waiting doesn't use cpu time
+    assert 0 <= record["thread_time"] <= record["process_time"] + 0.001
+    assert record["voluntary_context_switches"] >= 0
+    assert "gc_collections" not in record
+
+    with peek.timer(show_gc=True, show_enter=False):
+        gc.collect()
+        gc.collect()
+    out = capsys.readouterr().out
+    assert out.startswith("exit in ")
+    assert " (gc: 2 collections in " in out
+    assert "(cpu: " not in out
+    assert sys.modules[type(peek).__module__]._Usage.gc_callback not in gc.callbacks  # removed when the last timer with show_gc exits
+
+
+def test_threshold(capsys):
+    rendered = []
+
+    class Request:
+        def __init__(self, duration):
+            self.duration = duration
+
+        def __repr__(self):
+            rendered.append(self.duration)
+            return f"Request({self.duration})"
+
+    @peek.timer(threshold=0.5)
+    def handle(request):
+        peek.fix_perf_counter(request.duration)
+        return "ok"
+
+    peek.fix_perf_counter(0)
+    handle(Request(0.1))
+    assert capsys.readouterr().out == ""
+    assert rendered == []  # the arguments of a fast call are never rendered
+
+    peek.fix_perf_counter(0)
+    handle(Request(2))
+    assert capsys.readouterr().out == "returned 'ok' from handle(Request(2)) in 2.000000 seconds\n"
+
+    peek.fix_perf_counter(0)
+    with peek.timer(threshold=1):
+        peek.fix_perf_counter(0.5)
+    assert capsys.readouterr().out == ""
+
+    peek.fix_perf_counter(0)
+    with peek.timer(threshold=1, show_traceback=True):
+        peek.fix_perf_counter(1.5)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "exit in 1.500000 seconds"
+    assert lines[-1] == "        with peek.timer(threshold=1, show_traceback=True):"  # the stack as captured on entry
+    peek.fix_perf_counter(None)
+
+
+def test_bench(capsys):
+    def add(x, y=1):
+        return x + y
+
+    result = peek.fork(repeat=3, min_time=0.001).bench(add, 1, y=2)
+    assert len(result.durations) == 3
+    assert result.number >= 1
+    assert 0 <= result.min <= result.median
+    assert result.iqr >= 0
+    assert capsys.readouterr().out.startswith("bench add(1, y=2): min ")
+
+    loops = 0
+    with peek.bench(repeat=2, min_time=0.001) as b:
+        for _ in b:
+            loops += 1
+    assert len(b.result.durations) == 2
+    assert loops > 2 * b.result.number
+    out = capsys.readouterr().out
+    assert out.startswith("bench #") and "(2 rounds of " in out
+
+    with pytest.raises(TypeError):
+        with peek.bench(min_time=0.001):
+            pass
+    with pytest.raises(TypeError):
+        with peek.bench(min_time=0.001) as b:
+            for _ in b:
+                break
+    import gc
+
+    assert gc.isenabled()
+    assert capsys.readouterr().out == ""
+
+
+def test_scaling(capsys):
+    ScalingResult = sys.modules[type(peek).__module__]._ScalingResult
+    sizes = [10, 100, 1000, 10000, 100000]
+    for model, f in (
+        ("O(log n)", lambda n: 1e-6 + 2e-7 * math.log(n)),
+        ("O(n)", lambda n: 1e-6 + 3e-8 * n),
+        ("O(n log n)", lambda n: 1e-6 + 3e-8 * n * math.log(n)),
+        ("O(n^2)", lambda n: 1e-6 + 1e-10 * n * n),
+    ):
+        result = ScalingResult("f", sizes, [f(n) * (1.01 if i % 2 else 0.99) for i, n in enumerate(sizes)], target=10**7)
+        assert result.best == model
+        assert result.r_squared > 0.99
+        assert result.predicted == pytest.approx(f(10**7), rel=0.05)
+    assert ScalingResult("f", sizes, [1e-6, 1.02e-6, 0.99e-6, 1.01e-6, 1e-6]).best == "O(1)"
+
+    with pytest.raises(ValueError):
+        peek.scaling(sum, [10, 100], range)
+    result = peek.fork(repeat=1, min_time=0.0001).scaling(sum, [10, 100, 1000], range, target=10000)
+    assert result.sizes == [10, 100, 1000]
+    assert len(result.durations) == 3
+    assert capsys.readouterr().out.startswith("scaling sum: best fit ")
+
+
 def test_return_none(capsys):
     a = 2
     result = peek(a, a)
@@ -872,6 +1675,29 @@ peek|
     )
 
 
+def test_single_pass_layout(capsys):
+    _Serialized = sys.modules[type(peek).__module__]._Serialized
+    serialized = []
+
+    def serialize(obj):
+        serialized.append(obj)
+        return repr(obj)
+
+    a = 30 * ["abc"]
+    b = 1
+    peek(a, b, serialize=serialize)
+    out, err = capsys.readouterr()
+    assert out == f"a={a!r}\nb=1\n"
+    assert serialized == [a, b]
+
+    d = {i: 10 * "x" for i in range(20)}
+    d_serialized = _Serialized(peek, d)
+    d_serialized(10000)
+    assert d_serialized.is_multiline(71)
+    assert d_serialized(100000) == repr(d)
+    assert list(d_serialized.by_width) == [10000]
+
+
 def test_compact(capsys):
     a = 9 * ["0123456789"]
     peek(a, ll=80)
@@ -975,6 +1801,31 @@ def test_enabled2(capsys):
         assert s2 == "'s2'\n"
 
 
+def test_disabled_fast_path(capsys):
+    def add2(x):
+        return x + 2
+
+    with peek.preserve():
+        peek.enabled = False
+        n_call_sites = len(type(peek)._call_sites)
+        assert peek(1, line_length=120) == 1
+        assert peek(1, 2, return_none=True) is None
+        assert peek(1, as_str=True) == ""
+        assert peek.timer(add2) is add2
+        assert peek.timer()(add2) is add2
+        assert peek(add2, as_timer=True) is add2
+        with peek.timer():
+            pass
+        assert len(type(peek)._call_sites) == n_call_sites
+
+        peek.enabled = True
+        timed_add2 = peek.timer(add2)
+        peek.enabled = False
+        assert timed_add2(1) == 3
+    out, err = capsys.readouterr()
+    assert out == ""
+
+
 def test_wrap_indent():
     s = 4 * ["*******************"]
     with peek.preserve():
@@ -1162,6 +2013,38 @@ def test_propagation():
         assert y2.prefix == "x"
 
 
+def test_resolved_attributes():
+    with peek.preserve():
+        y0 = peek.fork()
+        y1 = y0.fork(prefix="y1")
+        assert y0.resolved_attributes() is peek.resolved_attributes()
+        assert y1.resolved_attributes() is y1.resolved_attributes()
+        peek.line_length = 123
+        assert y1.line_length == y0.line_length == 123
+        assert y1.prefix == "y1"
+        y0.configure(line_length=456)
+        assert (peek.line_length, y0.line_length, y1.line_length) == (123, 456, 456)
+        y0.line_length = None
+        assert y1.line_length == 123
+
+        # an instance without descendants (like the forks that are made for every call) only invalidates its own snapshot
+        resolved = y1.resolved_attributes()
+        generation = type(peek)._generation
+        y1.line_length = 80
+        y1.configure(prefix="y1 ")
+        assert type(peek)._generation == generation
+        assert y1.resolved_attributes() is not resolved
+        assert (y1.line_length, y1.prefix, y0.line_length) == (80, "y1 ", 123)
+        y2 = y1.fork()
+        y1.line_length = 90
+        assert type(peek)._generation == generation + 1
+        assert y2.line_length == 90
+
+        peek.fork(output="null")(1, json_lines=True)
+        peek.fork(output="null")()
+        assert type(peek)._generation == generation + 1
+
+
 def test_delta_propagation():
     with peek.preserve():
         y_delta_start = peek.delta